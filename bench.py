@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+# Benchmarks for fat.py and selector.py, run against synthetic images built by
+# mkfatimage.py, so that no physical stick is needed. Results can be saved and
+# compared against those of a previous run to spot regressions.
+
+import sys
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import random
+import timeit
+from StringIO import StringIO
+
+import fat as fatmodule
+from fat import FAT
+from selector import Fat32Filesystem, Selector, remap, verify
+import mkfatimage
+
+# Name: keyword arguments for mkfatimage.generate ()
+CASES = [
+	("fat12-small", dict (fatType = FAT.Type.FAT12, nFiles = 30, depth = 1, perDir = 10, sectorsPerCluster = 16)),
+	("fat16-medium", dict (fatType = FAT.Type.FAT16, nFiles = 200, depth = 2, perDir = 10, sectorsPerCluster = 16)),
+	("fat32-medium-fragmented", dict (fatType = FAT.Type.FAT32, nFiles = 200, depth = 2, perDir = 10,
+		sectorsPerCluster = 8, fragmented = 0.5, fragments = 8)),
+	("fat32-large", dict (fatType = FAT.Type.FAT32, nFiles = 999, depth = 3, perDir = 10, lfnLength = 40,
+		sectorsPerCluster = 8)),
+]
+
+# Number of files read by the read_file(s) benchmarks
+READ_FILES = 20
+
+# Size of the block cache used by the +bc benchmarks
+BLOCK_CACHE = 8 * 1024 * 1024
+
+# Results format, bump when it changes incompatibly
+VERSION = 1
+
+class Quiet (object):
+	"""Swallows whatever is printed while in effect"""
+	def __enter__ (self):
+		sys.stdout = StringIO ()
+
+	def __exit__ (self, *args):
+		sys.stdout = sys.__stdout__
+
+def best (func, repeat):
+	"""Returns the shortest of repeat runs of func, in seconds"""
+	ret = None
+	for n in xrange (repeat):
+		start = timeit.default_timer ()
+		func ()
+		t = timeit.default_timer () - start
+		if ret is None or t < ret:
+			ret = t
+	return ret
+
+class Case (object):
+	def __init__ (self, name, params, workdir):
+		self.name = name
+		self.image = os.path.join (workdir, name + ".img")
+		with open (self.image, "w+b") as fp:
+			mkfatimage.generate (fp, **params)
+
+		# The image is not mounted, like the CLI Selector works on it directly
+		fs = Fat32Filesystem (self.image, None, useCache = False)
+		self.selectorAdf = fs.fat.read_file ("selector.adf")
+
+		adfs = [f for f in fs.files if not f["attributes"] & FAT.Attribute.DIRECTORY and f["name"] != "selector.adf"]
+		self.paths = [f["name"] for f in adfs]
+		self.clusters = [f["cluster"] for f in adfs]
+		self.dir = self.paths[-1].rpartition ("/")[0]
+
+	def resetSelector (self):
+		with open (self.image, "r+b") as fp:
+			with FAT (fp).open ("selector.adf", writable = True) as adf:
+				adf.write (self.selectorAdf)
+
+	def fat (self, **kwargs):
+		return FAT (open (self.image, "rb"), **kwargs)
+
+	def benchReadDir (self):
+		self.fat ().read_dir (self.dir)
+
+	def benchClusterChains (self):
+		fat = self.fat (cache_fat = True)
+		for c in self.clusters:
+			fat.get_cluster_chain (c)
+
+	def benchReadFile (self):
+		fat = self.fat (cache_fat = True, use_mmap = True)
+		for path in self.paths[:READ_FILES]:
+			fat.read_file (path)
+
+	def benchReadFileView (self):
+		fat = self.fat (cache_fat = True, use_mmap = True)
+		for path in self.paths[:READ_FILES]:
+			fat.read_file_view (path)
+
+	def benchReadFiles (self):
+		fat = self.fat (cache_fat = True, use_mmap = True)
+		for path, data in fat.read_files (self.paths[:READ_FILES]):
+			pass
+
+	def benchRefresh (self):
+		Fat32Filesystem (self.image, None, useCache = False).refresh ()
+
+	def benchRefreshBlockCache (self):
+		Fat32Filesystem (self.image, None, useCache = False, blockCache = BLOCK_CACHE).refresh ()
+
+	def benchScan (self):
+		Selector (self.image, None, useCache = False).scan ()
+
+	def benchRemap (self):
+		self.resetSelector ()
+		s = Selector (self.image, None, useCache = False, writable = True)
+		s.scan ()
+		with Quiet ():
+			remap (s)
+
+	def benchVerify (self):
+		s = Selector (self.image, None, useCache = False)
+		s.scan ()
+		with Quiet ():
+			verify (s, useCache = False)
+
+	BENCHMARKS = [
+		("FAT.read_dir", benchReadDir),
+		("FAT.get_cluster_chain", benchClusterChains),
+		("FAT.read_file", benchReadFile),
+		("FAT.read_file_view", benchReadFileView),
+		("FAT.read_files", benchReadFiles),
+		("Fat32Filesystem.refresh", benchRefresh),
+		("Fat32Filesystem.refresh+bc", benchRefreshBlockCache),
+		("Selector.scan", benchScan),
+		("remap", benchRemap),
+		("verify", benchVerify),
+	]
+
+def checkChains (rounds = 30):
+	"""Cross-links clusters at random on a synthetic FAT16 image and checks
+	that FAT.get_all_chains () agrees with and without NumPy. Returns the
+	number of rounds in which they did not."""
+	if fatmodule.numpy is None:
+		return 0
+	image = StringIO ()
+	mkfatimage.generate (image, fatType = FAT.Type.FAT16, nFiles = 30, depth = 1, perDir = 10,
+		sectorsPerCluster = 16, fragmented = 0.5, extraClusters = 64)
+	nBad = 0
+	for seed in xrange (rounds):
+		rnd = random.Random (seed)
+		fat = FAT (StringIO (image.getvalue ()), cache_fat = True)
+		table = fat.fat_array ()
+		n = len (table)
+		# Make chains run into a few free clusters, as well as anywhere else
+		targets = rnd.sample ([c for c in xrange (2, n) if table[c] == 0], 3)
+		for i in xrange (rnd.randrange (1, 20)):
+			target = rnd.choice (targets) if rnd.random () < 0.5 else rnd.randrange (2, n)
+			fat.write_fat_entry (rnd.randrange (2, n), target)
+		chains = fat.get_all_chains ()
+		fatmodule.numpy, saved = None, fatmodule.numpy
+		try:
+			expected = fat.get_all_chains ()
+		finally:
+			fatmodule.numpy = saved
+		if chains != expected:
+			nBad += 1
+	return nBad
+
+def run (cases, repeat, workdir):
+	results = {}
+	for name, params in CASES:
+		if cases and name not in cases:
+			continue
+		print "Generating %s..." % name
+		sys.stdout.flush ()
+		case = Case (name, params, workdir)
+		results[name] = {}
+		for bench, func in Case.BENCHMARKS:
+			t = best (lambda: func (case), repeat)
+			results[name][bench] = t
+			print "  %-32s %10.3f ms" % (bench, t * 1000)
+			sys.stdout.flush ()
+	return results
+
+def compare (results, baseline, threshold):
+	"""Prints how results changed relative to baseline, returns the number of
+	benchmarks that got slower by more than threshold times"""
+	nSlower = 0
+	print
+	print "%-24s %-32s %10s %10s %7s" % ("Case", "Benchmark", "Before", "After", "Ratio")
+	for name in sorted (results):
+		for bench, t in sorted (results[name].iteritems ()):
+			old = baseline.get (name, {}).get (bench)
+			if old is None:
+				continue
+			ratio = t / old if old else float ("inf")
+			mark = ""
+			if ratio > threshold:
+				mark = " SLOWER"
+				nSlower += 1
+			elif ratio < 1 / threshold:
+				mark = " faster"
+			print "%-24s %-32s %8.3fms %8.3fms %6.2fx%s" % (name, bench, old * 1000, t * 1000, ratio, mark)
+	return nSlower
+
+def main ():
+	parser = argparse.ArgumentParser (description = 'Benchmark fat.py and selector.py on synthetic images')
+	parser.add_argument ('--case', action = 'append', default = [], dest = "cases",
+											 choices = [name for name, params in CASES], help = "Only run this case (can be repeated)")
+	parser.add_argument ('--repeat', type = int, default = 3, help = "Runs per benchmark, the best one counts")
+	parser.add_argument ('--output', "-o", default = None, help = "Save results to this JSON file")
+	parser.add_argument ('--compare', default = None, help = "Compare results to those saved in this JSON file")
+	parser.add_argument ('--threshold', type = float, default = 1.2,
+											 help = "Ratio over which a benchmark counts as a regression")
+	parser.add_argument ('--workdir', default = None, help = "Build images here and keep them (default: temporary directory)")
+	args = parser.parse_args ()
+
+	baseline = None
+	if args.compare:
+		with open (args.compare, "r") as fp:
+			data = json.load (fp)
+		if data.get ("version") != VERSION:
+			print "ERROR: %s was saved by an incompatible version" % args.compare
+			sys.exit (10)
+		baseline = data["results"]
+
+	nBad = checkChains ()
+	if nBad:
+		print "ERROR: FAT.get_all_chains () differs with and without NumPy in %d cases" % nBad
+		sys.exit (2)
+
+	workdir = args.workdir or tempfile.mkdtemp (prefix = "gotekonf-bench-")
+	try:
+		if not os.path.isdir (workdir):
+			os.makedirs (workdir)
+		results = run (args.cases, args.repeat, workdir)
+	finally:
+		if not args.workdir:
+			shutil.rmtree (workdir, ignore_errors = True)
+
+	if args.output:
+		with open (args.output, "w") as fp:
+			json.dump ({
+				"version": VERSION,
+				"date": time.strftime ("%Y-%m-%dT%H:%M:%S"),
+				"python": platform.python_version (),
+				"platform": platform.platform (),
+				"repeat": args.repeat,
+				"results": results,
+			}, fp, indent = 2, sort_keys = True)
+		print "Results saved to %s" % args.output
+
+	if baseline is not None and compare (results, baseline, args.threshold) > 0:
+		sys.exit (1)
+
+if __name__ == "__main__":
+	main ()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# A read cache for devices and images accessed without memory mapping: any
+# file object can be wrapped, reads are then served from a bounded LRU of
+# fixed-size aligned blocks, which is filled ahead when access is sequential.
+
+from os import SEEK_SET, SEEK_CUR, SEEK_END
+from collections import OrderedDict
+
+import iostats
+
+class BlockCachedFile (object):
+	"""Wraps a file object caching what is read from it in blocks of
+	blockSize bytes, aligned to multiples of blockSize, keeping at most
+	maxBytes of them and dropping the least recently used ones first.
+
+	Whenever a block is missed right after the previous one, the following
+	ones are fetched with the same read, up to readahead blocks, so walking
+	chains and extents takes few large reads instead of many small ones.
+	Reads larger than a quarter of the cache go straight to the file, so
+	that reading a whole disk image does not flush everything else.
+
+	Writes go straight to the file and drop the blocks they touch. Note that
+	the file cannot be memory-mapped through this, as that would bypass the
+	cache altogether.
+
+	Hits and misses are counted, in an IOStats instance as well if given."""
+
+	def __init__ (self, fp, blockSize = 4096, maxBytes = 8 * 1024 * 1024, readahead = 32, stats = None):
+		self._fp = fp
+		self._stats = stats if stats is not None else iostats.NULL
+		self.blockSize = blockSize
+		self.maxBlocks = max (1, maxBytes / blockSize)
+		self.readahead = max (1, min (readahead, self.maxBlocks))
+		self._blocks = OrderedDict ()
+		self._pos = fp.tell ()
+		self._window = 1
+		self._nextBlock = None
+		self.hits = 0
+		self.misses = 0
+
+	def _fetch (self, first, count):
+		"""Reads count blocks starting with first into the cache, stopping
+		at the end of the file"""
+		bs = self.blockSize
+		self._fp.seek (first * bs, SEEK_SET)
+		data = self._fp.read (count * bs)
+		for n in xrange (0, len (data), bs):
+			self._store (first + n / bs, data[n:n + bs])
+		self._nextBlock = first + count
+		return data
+
+	def _store (self, block, data):
+		self._blocks.pop (block, None)
+		self._blocks[block] = data
+		while len (self._blocks) > self.maxBlocks:
+			self._blocks.popitem (last = False)
+
+	def _getBlock (self, block):
+		data = self._blocks.pop (block, None)
+		if data is not None:
+			# Most recently used blocks go last
+			self._blocks[block] = data
+			self.hits += 1
+			self._stats.count ("block_cache_hits")
+			return data
+
+		self.misses += 1
+		self._stats.count ("block_cache_misses")
+		if block == self._nextBlock:
+			# Sequential access, widen the window
+			self._window = min (self._window * 2, self.readahead)
+		else:
+			self._window = 1
+		count = 1
+		while count < self._window and block + count not in self._blocks:
+			count += 1
+		data = self._fetch (block, count)
+		return data[:self.blockSize]
+
+	def read (self, size = -1):
+		bs = self.blockSize
+		start = self._pos
+		if size < 0 or (size + bs - 1) / bs > self.maxBlocks / 4:
+			# Too large to be worth caching
+			self._fp.seek (start, SEEK_SET)
+			data = self._fp.read (size)
+			self._pos = start + len (data)
+			return data
+
+		end = start + size
+		chunks = []
+		block = start / bs
+		while start < end:
+			data = self._getBlock (block)
+			offset = start - block * bs
+			chunk = data[offset:offset + end - start]
+			if not chunk:
+				break
+			chunks.append (chunk)
+			start += len (chunk)
+			if len (data) < bs:
+				# End of file
+				break
+			block += 1
+		self._pos = start
+		return chunks[0] if len (chunks) == 1 else "".join (chunks)
+
+	def readinto (self, buf):
+		data = self.read (len (buf))
+		buf[:len (data)] = data
+		return len (data)
+
+	def write (self, data):
+		self._fp.seek (self._pos, SEEK_SET)
+		self._fp.write (data)
+		bs = self.blockSize
+		for block in xrange (self._pos / bs, (self._pos + len (data) + bs - 1) / bs):
+			self._blocks.pop (block, None)
+		self._pos += len (data)
+
+	def seek (self, offset, whence = SEEK_SET):
+		if whence == SEEK_SET:
+			self._pos = offset
+		elif whence == SEEK_CUR:
+			self._pos += offset
+		else:
+			self._fp.seek (offset, SEEK_END)
+			self._pos = self._fp.tell ()
+
+	def tell (self):
+		return self._pos
+
+	def invalidate (self):
+		"""Drops all cached blocks, e.g. if the file was changed elsewhere"""
+		self._blocks.clear ()
+		self._nextBlock = None
+
+	def fileno (self):
+		raise IOError ("File is accessed through a block cache and cannot be mapped")
+
+	def flush (self):
+		self._fp.flush ()
+
+	def close (self):
+		self._blocks.clear ()
+		self._fp.close ()
+
+	def __getattr__ (self, name):
+		return getattr (self._fp, name)
+
+	def __enter__ (self):
+		return self
+
+	def __exit__ (self, *args):
+		self.close ()
@@ -3,10 +3,27 @@
 # Derived from pyfat: https://github.com/jonasgulle/pyfat
 
 from datetime import datetime, date
-from struct import unpack
-from os import SEEK_SET
+from struct import Struct, pack, unpack, unpack_from
+from os import SEEK_SET, SEEK_CUR, SEEK_END
+from array import array
+from bisect import bisect_right
+import sys
+import mmap
+import hashlib
 import logging
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# Zero-copy slice of a buffer (Python 2 mmap objects don't support memoryview)
+try:
+	_view = buffer
+except NameError:
+	def _view(obj, offset, size):
+		return memoryview(obj)[offset:offset + size]
+
 # https://www.pjrc.com/tech/8051/ide/fat32.html
 # https://en.wikipedia.org/wiki/Design_of_the_FAT_file_system#VFAT
 
@@ -17,8 +34,27 @@ class FAT(object):
 	EOF_FAT12 = 0x00000ff8
 	EOF_FAT16 = 0x0000fff8
 	EOF_FAT32 = 0x0ffffff8
+	BAD_FAT12 = 0x00000ff7
+	BAD_FAT16 = 0x0000fff7
+	BAD_FAT32 = 0x0ffffff7
 	# The size of a FAT directory entry
 	DIRSIZE = 32
+	# Largest single read done by read_files(), and largest gap it reads
+	# through rather than seeking over it
+	BATCH_READ = 4 * 1024 * 1024
+	BATCH_GAP = 64 * 1024
+	# Value of cache_fat to load the FAT when first needed
+	LAZY = "lazy"
+	# Flags in byte 12 of a directory entry: the 8.3 name or extension is to
+	# be shown in lowercase
+	NT_LOWER_BASE = 0x08
+	NT_LOWER_EXT = 0x10
+	# Encoding of 8.3 names
+	OEM_CODEPAGE = "cp437"
+	# Layout of a directory entry: name, attributes, creation time (tenths,
+	# time, date), access date, cluster (high word), modification time and
+	# date, cluster (low word), size
+	_DIRENT = Struct("<11sBxBHHHHHHHL")
 
 	class Type:
 		FAT12 = 1
@@ -35,17 +71,280 @@ class FAT(object):
 		ARCHIVE = 0x20
 		LONGNAME = READONLY | HIDDEN | SYSTEM | LABEL
 
+	# A directory entry, as returned by read_dir(). Timestamps are kept in
+	# their packed form and only decoded when accessed. Entries can also be
+	# used as dicts with the same keys as the attributes, for compatibility.
+	class DirEntry(object):
+		__slots__ = ("name", "attributes", "cluster", "size", "direntry",
+			"_ctime_tenth", "_ctime", "_cdate", "_adate", "_mtime", "_mdate")
+
+		KEYS = ("name", "attributes", "created", "last_accessed", "modified", "cluster", "size", "direntry")
+
+		def __init__(self, name, attributes, cluster, size, direntry,
+				ctime_tenth=0, ctime=0, cdate=0, adate=0, mtime=0, mdate=0):
+			self.name = name
+			self.attributes = attributes
+			self.cluster = cluster
+			self.size = size
+			self.direntry = direntry
+			self._ctime_tenth = ctime_tenth
+			self._ctime = ctime
+			self._cdate = cdate
+			self._adate = adate
+			self._mtime = mtime
+			self._mdate = mdate
+
+		@property
+		def created(self):
+			return FAT._parse_fat_datetime(self._ctime_tenth, self._ctime, self._cdate)
+
+		@property
+		def last_accessed(self):
+			return FAT._parse_fat_date(self._adate)
+
+		@property
+		def modified(self):
+			return FAT._parse_fat_datetime(0, self._mtime, self._mdate)
+
+		def is_dir(self):
+			return bool(self.attributes & FAT.Attribute.DIRECTORY)
+
+		# Dict-style access
+		def __getitem__(self, key):
+			if key not in FAT.DirEntry.KEYS:
+				raise KeyError(key)
+			return getattr(self, key)
+
+		def __setitem__(self, key, value):
+			if key not in FAT.DirEntry.__slots__ or key.startswith("_"):
+				raise KeyError(key)
+			setattr(self, key, value)
+
+		def __contains__(self, key):
+			return key in FAT.DirEntry.KEYS
+
+		def get(self, key, default=None):
+			return self[key] if key in self else default
+
+		def keys(self):
+			return list(FAT.DirEntry.KEYS)
+
+		def __iter__(self):
+			return iter(FAT.DirEntry.KEYS)
+
+		# Raw fields, in the same order as the constructor arguments
+		def fields(self):
+			return tuple(getattr(self, k) for k in FAT.DirEntry.__slots__)
+
+		def __reduce__(self):
+			return (_dir_entry, self.fields())
+
+		def __eq__(self, other):
+			return isinstance(other, FAT.DirEntry) and self.fields() == other.fields()
+
+		def __ne__(self, other):
+			return not self == other
+
+		def __repr__(self):
+			return "<DirEntry %r (attr=0x%02x, c=%u, size=%u)>" % (self.name, self.attributes, self.cluster, self.size)
+
+	# A directory of the volume, only parsed the first time its entries are
+	# needed, see FAT.dir_node(). Entries are also indexed by case-folded name.
+	class DirNode(object):
+		__slots__ = ("fat", "cluster", "_entries", "_by_name")
+
+		def __init__(self, fat, cluster):
+			self.fat = fat
+			self.cluster = cluster
+			self._entries = None
+			self._by_name = None
+
+		def entries(self):
+			if self._entries is None:
+				self._entries = self.fat.read_dir_cluster(self.cluster)
+				self._by_name = {}
+				for e in self._entries:
+					self._by_name.setdefault(e.name.lower(), e)
+			return self._entries
+
+		def loaded(self):
+			return self._entries is not None
+
+		# Returns the entry with the given name, whatever its case, or None
+		def lookup(self, name):
+			if self._by_name is None:
+				self.entries()
+			return self._by_name.get(name.lower())
+
+		# Returns the DirNode of the given subdirectory, or None
+		def subdir(self, name):
+			e = self.lookup(name)
+			if e is None or not e.is_dir():
+				return None
+			return self.fat._get_node(e.cluster)
+
+	# A seekable file-like object on a file of the volume, see FAT.open().
+	# Offsets are mapped to clusters through the extents of the file, and data
+	# is read from the device in chunks of at most CHUNK bytes, so memory usage
+	# is bounded whatever the file size. If readahead is given, short reads
+	# fetch that many bytes at once and the following reads are served from
+	# memory. If writable is True, data can be overwritten in place, but the
+	# file cannot grow.
+	class File(object):
+		CHUNK = 1024 * 1024
+
+		def __init__(self, fat, entry, readahead=0, writable=False):
+			self.fat = fat
+			self.name = entry["name"]
+			self.size = entry["size"]
+			self.closed = False
+			self._writable = writable
+			self._readahead = readahead
+			self._ahead = ""
+			self._ahead_pos = 0
+			self._pos = 0
+			self._extents = fat.get_cluster_extents(entry["cluster"], load=False)
+			# File offset where every extent begins
+			self._starts = []
+			pos = 0
+			csize = fat.cluster_size()
+			for start, count in self._extents:
+				self._starts.append(pos)
+				pos += count * csize
+
+		def __enter__(self):
+			return self
+
+		def __exit__(self, *exc):
+			self.close()
+
+		def close(self):
+			self.closed = True
+			self._ahead = ""
+
+		def readable(self):
+			return True
+
+		def seekable(self):
+			return True
+
+		def writable(self):
+			return self._writable
+
+		def tell(self):
+			return self._pos
+
+		def seek(self, offset, whence=SEEK_SET):
+			if whence == SEEK_CUR:
+				offset += self._pos
+			elif whence == SEEK_END:
+				offset += self.size
+			elif whence != SEEK_SET:
+				raise ValueError("Invalid whence: %r" % whence)
+			if offset < 0:
+				raise IOError("Negative seek position %d" % offset)
+			self._pos = offset
+			return self._pos
+
+		# Device offset for a file offset, and how many bytes can be read
+		# from there before the extent (or the file) ends. Nothing can be
+		# read past the end of the chain, should it be shorter than the file.
+		def __locate(self, pos):
+			n = bisect_right(self._starts, pos) - 1
+			if n < 0:
+				return None, 0
+			start, count = self._extents[n]
+			within = pos - self._starts[n]
+			csize = self.fat.cluster_size()
+			avail = min(count * csize - within, self.size - pos)
+			if avail <= 0:
+				return None, 0
+			return self.fat.cluster_to_offset(start) + within, avail
+
+		def readinto(self, b):
+			if self.closed:
+				raise ValueError("I/O operation on closed file")
+			view = memoryview(b)
+			want = max(0, min(len(view), self.size - self._pos))
+			done = 0
+			while done < want:
+				ahead = self._pos - self._ahead_pos
+				if 0 <= ahead < len(self._ahead):
+					# Serve from the readahead buffer
+					chunk = _view(self._ahead, ahead, want - done)
+				else:
+					offset, avail = self.__locate(self._pos)
+					if avail <= 0:
+						break
+					n = min(want - done, avail, FAT.File.CHUNK)
+					if n < self._readahead:
+						self._ahead = self.fat._read_at(offset, min(avail, self._readahead))
+						self._ahead_pos = self._pos
+						if not self._ahead:
+							break
+						continue
+					chunk = self.fat._read_at(offset, n)
+					if not chunk:
+						break
+				view[done:done + len(chunk)] = chunk
+				done += len(chunk)
+				self._pos += len(chunk)
+			return done
+
+		def read(self, n=-1):
+			remaining = max(0, self.size - self._pos)
+			if n is None or n < 0 or n > remaining:
+				n = remaining
+			buf = bytearray(n)
+			got = self.readinto(buf)
+			return str(buf[:got]) if got < n else str(buf)
+
+		def write(self, data):
+			if self.closed:
+				raise ValueError("I/O operation on closed file")
+			elif not self._writable:
+				raise IOError("File not open for writing")
+			elif self._pos + len(data) > self.size:
+				raise IOError("Cannot write past the end of %s" % self.name)
+			self._ahead = ""
+			done = 0
+			while done < len(data):
+				offset, avail = self.__locate(self._pos)
+				if avail <= 0:
+					raise IOError("Cannot write past the end of the cluster chain of %s" % self.name)
+				n = min(len(data) - done, avail)
+				self.fat._write_at(offset, data[done:done + n])
+				done += n
+				self._pos += n
+			return done
+
+		def flush(self):
+			if self._writable:
+				self.fat.flush()
+
 	class FileNotFoundError(Exception):
 		def __init__(self, path):
 			self.path = path
 		def __str__(self):
 			return "The file or directory \"%s\" doesn't exist" % self.path
 
-	def __init__(self, fd):
+	# If cache_fat is True, the whole active FAT is loaded in memory right away
+	# and cluster chains are walked from there, see load_fat(). If it is
+	# FAT.LAZY, that only happens when a chain is first walked, so nothing is
+	# loaded by those who never need one.
+	# If use_mmap is True, the image or device is memory-mapped and all reads
+	# return views into the mapping instead of copies (falling back to plain
+	# reads if fd cannot be mapped).
+	# If stats is given (see iostats.py), reads served from the mapping are
+	# counted there, those through fd can be counted by wrapping it.
+	def __init__(self, fd, cache_fat=False, use_mmap=False, stats=None):
 		self._logger = logging.getLogger ("FAT")
 		#~ self._logger.setLevel (logging.DEBUG)
 		self.fd = fd
+		if stats is not None:
+			stats.instrumentFat(self)
 		self.__start = fd.tell()
+		self.__mmap = self.__map(fd) if use_mmap else None
 		self.info = self.__parse_bootsector()
 		self._logger.debug ("FAT INFO: %s", self.info)
 
@@ -54,14 +353,34 @@ class FAT(object):
 		self.__fat_start = self.__start + self.info["reserved_sectors"] * self.info["sector_size"]
 
 		self.fat_type, self.EOF, self.__num_clusters = self.__determine_type()
+		self.BAD = {FAT.Type.FAT12: FAT.BAD_FAT12, FAT.Type.FAT16: FAT.BAD_FAT16}.get(self.fat_type, FAT.BAD_FAT32)
 		self._logger.debug ("FAT Type: %s", self.fat_type)
 		self._logger.debug ("Number of clusters: %u", self.__num_clusters)
+		if self.fat_type != FAT.Type.FAT32:
+			# These only exist in the FAT32 boot sector, the root directory
+			# has a fixed location otherwise
+			self.info["flags"] = self.info["ver"] = self.info["root_start_cluster"] = None
+
+		# Offsets of all the copies of the FAT. On FAT32 mirroring can be
+		# disabled, in which case only the active copy is used and updated.
+		fat_size = self.info["sectors_per_fat"] * self.info["sector_size"]
+		self.__fat_offsets = [self.__fat_start + n * fat_size for n in range(self.info["num_fats"])]
+		if self.fat_type == FAT.Type.FAT32 and self.info["flags"] & 0x80:
+			active = self.info["flags"] & 0x0f
+			if active < len(self.__fat_offsets):
+				self.__fat_offsets = [self.__fat_offsets[active]]
+				self.__fat_start = self.__fat_offsets[0]
+		self.__fat_table = None
+		self.__lazy_fat = cache_fat == FAT.LAZY
+		self.invalidate_dirs()
+		if cache_fat and not self.__lazy_fat:
+			self.load_fat()
 
 		# Calculate the offset to the root directory
 		# cluster_begin_lba
 		if "root_start_cluster" in self.info and self.info["root_start_cluster"] is not None:
 			#~ assert self.info["root_start_cluster"] == 2
-			self.__data_start = (self.info["reserved_sectors"] + (self.info["num_fats"] * self.info["sectors_per_fat"])) * self.info["sector_size"]
+			self.__data_start = self.__start + (self.info["reserved_sectors"] + (self.info["num_fats"] * self.info["sectors_per_fat"])) * self.info["sector_size"]
 			self.__root_dir = self.cluster_to_offset (self.info["root_start_cluster"])
 		else:
 			self.__root_dir = ((self.info["num_fats"] * self.info["sectors_per_fat"]) *
@@ -72,6 +391,53 @@ class FAT(object):
 		self._logger.debug ("root offset: %u", self.__root_dir)
 		self._logger.debug ("data start: %u", self.__data_start)
 
+	# Map the whole image or device, read-only unless fd was opened for writing
+	def __map(self, fd):
+		try:
+			pos = fd.tell()
+			# Block devices have no size in stat(), so just seek to the end
+			fd.seek(0, SEEK_END)
+			size = fd.tell()
+			fd.seek(pos, SEEK_SET)
+			mode = getattr(fd, "mode", "rb")
+			access = mmap.ACCESS_WRITE if "+" in mode or "w" in mode else mmap.ACCESS_READ
+			mm = mmap.mmap(fd.fileno(), size, access=access)
+			self._logger.debug ("Mapped %u bytes", size)
+			return mm
+		except (EnvironmentError, ValueError, AttributeError, mmap.error) as e:
+			self._logger.warning ("Cannot map device, using plain reads: %s", e)
+			return None
+
+	def mapped(self):
+		return self.__mmap is not None
+
+	def flush(self):
+		if self.__mmap is not None:
+			self.__mmap.flush()
+		self.fd.flush()
+
+	def close(self):
+		if self.__mmap is not None:
+			self.__mmap.close()
+			self.__mmap = None
+		self.fd.close()
+
+	# Read size bytes at the given absolute offset. When the device is mapped
+	# this returns a view into the mapping and nothing is copied.
+	def _read_at(self, offset, size):
+		if self.__mmap is not None:
+			return _view(self.__mmap, offset, size)
+		self.fd.seek(offset, SEEK_SET)
+		return self.fd.read(size)
+
+	# Write data at the given absolute offset, fd must be open for writing
+	def _write_at(self, offset, data):
+		if self.__mmap is not None:
+			self.__mmap[offset:offset + len(data)] = str(data)
+		else:
+			self.fd.seek(offset, SEEK_SET)
+			self.fd.write(data)
+
 	# Determines which type of FAT it is depending on the properties
 	def __determine_type(self):
 		root_dir_sectors = ((self.info["root_entries"] * FAT.DIRSIZE) +
@@ -86,38 +452,674 @@ class FAT(object):
 		else:
 			return (FAT.Type.FAT32, FAT.EOF_FAT32, num_clusters)
 
+	# Read the raw bytes of the active FAT, just enough to cover all clusters
+	def __read_fat_bytes(self):
+		entries = self.__num_clusters + 2
+		if self.fat_type == FAT.Type.FAT12:
+			size = entries + (entries + 1) / 2
+		elif self.fat_type == FAT.Type.FAT16:
+			size = entries * 2
+		elif self.fat_type == FAT.Type.FAT32:
+			size = entries * 4
+		else:
+			raise NotImplementedError
+		raw = self._read_at(self.__fat_start, size)
+		if len(raw) < size:
+			raw += "\0" * (size - len(raw))
+		return raw
+
+	# Decode the active FAT as a whole into a NumPy array of uint32, one item
+	# per cluster
+	def __decode_fat(self, raw):
+		entries = self.__num_clusters + 2
+		if self.fat_type == FAT.Type.FAT12:
+			# Every 3 bytes pack two 12-bit entries
+			if len(raw) % 3:
+				raw = str(raw) + "\0" * (3 - len(raw) % 3)
+			b = numpy.frombuffer(raw, dtype=numpy.uint8).reshape(-1, 3).astype(numpy.uint32)
+			table = numpy.empty(len(b) * 2, dtype=numpy.uint32)
+			table[0::2] = b[:, 0] | ((b[:, 1] & 0x0f) << 8)
+			table[1::2] = (b[:, 1] >> 4) | (b[:, 2] << 4)
+			return table[:entries]
+		elif self.fat_type == FAT.Type.FAT16:
+			return numpy.frombuffer(raw, dtype="<u2", count=entries).astype(numpy.uint32)
+		else:
+			return numpy.frombuffer(raw, dtype="<u4", count=entries).astype(numpy.uint32)
+
+	# Load the whole active FAT in memory, in a compact array with one item per
+	# cluster (FAT12 entries are unpacked here once and for all)
+	def load_fat(self):
+		entries = self.__num_clusters + 2
+		raw = self.__read_fat_bytes()
+		typecode = "I" if self.fat_type == FAT.Type.FAT32 else "H"
+		if numpy is not None:
+			table = array(typecode, self.__decode_fat(raw).astype("=u%d" % array(typecode).itemsize).tostring())
+		elif self.fat_type == FAT.Type.FAT12:
+			raw = bytearray(raw + "\0")
+			table = array("H", [0]) * entries
+			for cluster in xrange(entries):
+				offset = cluster + (cluster / 2)
+				value = raw[offset] | (raw[offset + 1] << 8)
+				table[cluster] = value >> 4 if cluster & 1 else value & 0xfff
+		else:
+			table = array(typecode)
+			table.fromstring(raw)
+			if sys.byteorder != "little":
+				table.byteswap()
+		self.__fat_table = table
+		self._logger.debug ("Loaded FAT with %u entries", entries)
+
+	# Forget the in-memory FAT, if any, e.g. after the device was modified
+	# behind our back. Call load_fat() to read it again.
+	def invalidate_fat(self):
+		self.__fat_table = None
+
+	def fat_cached(self):
+		return self.__fat_table is not None
+
+	# Forget all the directories parsed so far and the paths resolved through
+	# them, they will be parsed again when next needed
+	def invalidate_dirs(self):
+		self.__dir_nodes = {}
+		self.__resolved = {}
+
+	# All DirNodes are kept here by starting cluster, so that every directory
+	# is parsed at most once however it is reached (e.g. through "..")
+	def _get_node(self, cluster):
+		node = self.__dir_nodes.get(cluster)
+		if node is None:
+			node = self.__dir_nodes[cluster] = FAT.DirNode(self, cluster)
+		return node
+
+	# Returns the DirNode of a directory, given its path. Resolved paths are
+	# remembered, so looking up many files in the same directory only walks
+	# the path once.
+	def dir_node(self, path=""):
+		key = "/".join(filter(len, path.lower().split("/")))
+		node = self.__resolved.get(key)
+		if node is None:
+			pos = key.rfind("/")
+			if not key:
+				node = self._get_node(0)
+			else:
+				node = self.dir_node(key[:pos] if pos >= 0 else "").subdir(key[pos + 1:])
+				if node is None:
+					raise FAT.FileNotFoundError(path)
+			self.__resolved[key] = node
+		return node
+
 	def __next_cluster(self, cluster):
+		if self.__fat_table is not None:
+			return self.__fat_table[cluster]
 		offset = self.__fat_start
 		if self.fat_type == FAT.Type.FAT12:
 			offset += cluster + (cluster / 2)
-			self.fd.seek(offset, SEEK_SET)
-			value = unpack("<H", self.fd.read(2))[0]
+			value = unpack_from("<H", self._read_at(offset, 2))[0]
 			return value >> 4 if cluster & 1 else value & 0xfff
 		elif self.fat_type == FAT.Type.FAT16:
 			offset += cluster * 2
-			self.fd.seek(offset, SEEK_SET)
-			return unpack("<H", self.fd.read(2))[0]
+			return unpack_from("<H", self._read_at(offset, 2))[0]
 		elif self.fat_type == FAT.Type.FAT32:
 			offset += cluster * 4
-			self.fd.seek(offset, SEEK_SET)
-			return unpack("<L", self.fd.read(4))[0]
+			return unpack_from("<L", self._read_at(offset, 4))[0]
 		else:
 			raise NotImplementedError
 
-	def get_cluster_chain(self, cluster):
+	# Return the active FAT as a NumPy array of uint32, one item per cluster
+	def fat_array(self):
+		if numpy is None:
+			raise NotImplementedError("NumPy is not available")
+		if self.__fat_table is not None:
+			table = self.__fat_table
+			return numpy.frombuffer(table, dtype=table.typecode).astype(numpy.uint32)
+		return self.__decode_fat(self.__read_fat_bytes())
+
+	# Compute per-cluster facts for the whole volume in one go. Returns a dict
+	# with boolean masks (indexed by cluster number) of free, used, bad and EOF
+	# clusters, plus the heads of all the chains (clusters that are never a
+	# successor) and their lengths. For every cluster it also tells how many
+	# clusters point to it ("npred"), how many links up to the end of its
+	# chain are not contiguous ("breaks") and the largest gap among them, in
+	# clusters.
+	def analyze_fat(self):
+		table = self.fat_array()
+		if self.fat_type == FAT.Type.FAT32:
+			table &= 0x0fffffff
+		n = len(table)
+		clusters = numpy.arange(n, dtype=numpy.int64)
+		valid = clusters >= 2
+		free = valid & (table == 0)
+		bad = valid & (table == self.BAD)
+		eof = valid & (table >= self.EOF)
+		used = valid & ~free & ~bad
+		link = used & (table >= 2) & (table < n)
+
+		# Clusters that some other cluster points to
+		npred = numpy.bincount(table[link], minlength=n)
+		head = used & (npred == 0)
+
+		# Pointer jumping: after k rounds every cluster knows the one 2^k links
+		# ahead and how far it is, so log2(n) rounds reach the end of all chains
+		succ = numpy.where(link, table, clusters).astype(numpy.int64)
+		dist = link.astype(numpy.int64)
+		jump = numpy.where(link, numpy.abs(succ - clusters - 1), 0)
+		breaks = (jump != 0).astype(numpy.int64)
+		for i in xrange(n.bit_length() + 1):
+			nxt = succ[succ]
+			if (nxt == succ).all():
+				break
+			dist += dist[succ]
+			breaks += breaks[succ]
+			jump = numpy.maximum(jump, jump[succ])
+			succ = nxt
+		# A chain that ended properly stops on a cluster with no successor,
+		# anything else ends up in a loop. Loops whose length is a power of
+		# two converge too, so this cannot be told by convergence alone.
+		loop = link[succ]
+
+		heads = numpy.flatnonzero(head)
+		return {
+			"next": table,
+			"free": free,
+			"used": used,
+			"bad": bad,
+			"eof": eof,
+			"loop": loop,
+			"heads": heads,
+			"npred": npred,
+			"lengths": dist[heads] + 1,
+			"tail": succ,
+			"distance": dist,
+			"breaks": breaks,
+			"gap": jump
+		}
+
+	# Walk a chain from the in-memory FAT, stopping if it loops back on itself
+	def __walk_chain(self, cluster):
+		chain = [cluster]
+		seen = set(chain)
+		table = self.__fat_table
+		n = len(table)
+		while True:
+			cluster = table[cluster]
+			if cluster >= self.EOF or cluster < 2 or cluster >= n or cluster in seen:
+				break
+			chain.append(cluster)
+			seen.add(cluster)
+		return chain
+
+	# Return the cluster chains of all the files and directories on the volume
+	# in a single pass over the FAT, as a dict mapping the starting cluster of
+	# every chain to the list of its clusters
+	def get_all_chains(self):
+		if self.__fat_table is None:
+			self.load_fat()
+		if numpy is None:
+			table = self.__fat_table
+			n = len(table)
+			succ = set(c for c in table[2:] if 2 <= c < n)
+			free = set([0, self.BAD])
+			return dict((c, self.__walk_chain(c)) for c in xrange(2, n) if c not in succ and table[c] not in free)
+
+		info = self.analyze_fat()
+		chains = {}
+		ok = info["used"] & ~info["loop"]
+		members = numpy.flatnonzero(ok)
+		# Group clusters by the chain end they lead to, from the farthest
+		order = numpy.lexsort((-info["distance"][members], info["tail"][members]))
+		members = members[order]
+		tails = info["tail"][members]
+		bounds = numpy.flatnonzero(numpy.diff(tails)) + 1
+		starts = numpy.concatenate(([0], bounds))
+		ends = numpy.concatenate((bounds, [len(members)]))
+		dist = info["distance"]
+		used = info["used"]
+		for start, end in zip(starts.tolist(), ends.tolist()):
+			if start == end:
+				# No chain is sound
+				continue
+			first = members[start]
+			# A free or bad tail is not among the members, so other chains
+			# running into it could make up the count by chance
+			if used[tails[start]] and end - start == dist[first] + 1:
+				chains[int(first)] = members[start:end].tolist()
+		# Cross-linked, looping and badly terminated chains are left to the
+		# slow path
+		for head in info["heads"].tolist():
+			if head not in chains:
+				chains[head] = self.__walk_chain(head)
+		return chains
+
+	# Return the set of clusters that more than one cluster points to, i.e.
+	# where chains are cross-linked
+	def get_cross_linked(self):
+		if self.__fat_table is None:
+			self.load_fat()
+		if numpy is not None:
+			return set(numpy.flatnonzero(self.analyze_fat()["npred"] > 1).tolist())
+		table = self.__fat_table
+		n = len(table)
+		seen = set()
+		ret = set()
+		for c in xrange(2, n):
+			nxt = table[c]
+			if 2 <= nxt < n:
+				if nxt in seen:
+					ret.add(nxt)
+				seen.add(nxt)
+		return ret
+
+	@staticmethod
+	def __fragmentation(clusters, extents, gap):
+		return {
+			"clusters": clusters,
+			"extents": extents,
+			"largest_gap": gap,
+			# Share of the links between clusters that are contiguous
+			"contiguous": 100.0 * (clusters - extents) / (clusters - 1) if clusters > 1 else 100.0
+		}
+
+	# Fragmentation of a single chain, given as a list of clusters
+	@staticmethod
+	def chain_fragmentation(chain):
+		extents = FAT.chain_to_extents(chain)
+		gaps = [abs(b[0] - (a[0] + a[1])) for a, b in zip(extents, extents[1:])]
+		return FAT.__fragmentation(len(chain), len(extents), max(gaps) if gaps else 0)
+
+	# Fragmentation of every chain on the volume, computed in a single pass
+	# over the FAT. Returns a dict mapping the starting cluster of every chain
+	# to a dict with its length in clusters, its number of extents, the
+	# largest gap between two consecutive extents (in clusters) and the
+	# percentage of contiguous links.
+	def get_fragmentation(self):
+		if numpy is None:
+			return dict((head, FAT.chain_fragmentation(chain)) for head, chain in self.get_all_chains().iteritems())
+		if self.__fat_table is None:
+			self.load_fat()
+		info = self.analyze_fat()
+		heads = info["heads"]
+		ret = {}
+		for head, clusters, breaks, gap, loop in zip(heads.tolist(), info["lengths"].tolist(),
+				info["breaks"][heads].tolist(), info["gap"][heads].tolist(), info["loop"][heads].tolist()):
+			if loop:
+				ret[head] = FAT.chain_fragmentation(self.__walk_chain(head))
+			else:
+				ret[head] = FAT.__fragmentation(clusters, breaks + 1, gap)
+		return ret
+
+	# Set the FAT entry for a cluster in all the copies of the FAT, keeping the
+	# in-memory table (if loaded) in sync. fd must be open for writing.
+	def write_fat_entry(self, cluster, value):
+		stored = value
+		for fat_offset in self.__fat_offsets:
+			if self.fat_type == FAT.Type.FAT12:
+				offset = fat_offset + cluster + (cluster / 2)
+				old = unpack_from("<H", self._read_at(offset, 2))[0]
+				if cluster & 1:
+					new = (old & 0x000f) | ((value & 0xfff) << 4)
+				else:
+					new = (old & 0xf000) | (value & 0xfff)
+				self._write_at(offset, pack("<H", new))
+			elif self.fat_type == FAT.Type.FAT16:
+				self._write_at(fat_offset + cluster * 2, pack("<H", value & 0xffff))
+			elif self.fat_type == FAT.Type.FAT32:
+				# The upper 4 bits are reserved and must be preserved
+				offset = fat_offset + cluster * 4
+				old = unpack_from("<L", self._read_at(offset, 4))[0]
+				stored = (old & 0xf0000000) | (value & 0x0fffffff)
+				self._write_at(offset, pack("<L", stored))
+			else:
+				raise NotImplementedError
+		if self.__fat_table is not None:
+			self.__fat_table[cluster] = stored
+
+	# Set many FAT entries at once, given as (cluster, value) pairs. Runs of
+	# consecutive clusters are written with a single write per FAT copy.
+	def write_fat_entries(self, entries):
+		if self.fat_type == FAT.Type.FAT12:
+			# Entries are not byte-aligned, not worth the trouble
+			for cluster, value in entries:
+				self.write_fat_entry(cluster, value)
+			return
+		runs = []
+		for cluster, value in sorted(entries):
+			if runs and runs[-1][0] + len(runs[-1][1]) == cluster:
+				runs[-1][1].append(value)
+			else:
+				runs.append((cluster, [value]))
+		fmt, width = ("H", 2) if self.fat_type == FAT.Type.FAT16 else ("L", 4)
+		for start, values in runs:
+			if self.fat_type == FAT.Type.FAT32:
+				# The upper 4 bits are reserved and must be preserved
+				old = unpack_from("<%u%s" % (len(values), fmt), self._read_at(self.__fat_start + start * width, len(values) * width))
+				values = [(o & 0xf0000000) | (v & 0x0fffffff) for o, v in zip(old, values)]
+			data = pack("<%u%s" % (len(values), fmt), *values)
+			for fat_offset in self.__fat_offsets:
+				self._write_at(fat_offset + start * width, data)
+			if self.__fat_table is not None:
+				self.__fat_table[start:start + len(values)] = array(self.__fat_table.typecode, values)
+
+	# Runs of free clusters, as a list of (start_cluster, run_length)
+	def get_free_extents(self):
+		if self.__fat_table is None:
+			self.load_fat()
+		table = self.__fat_table
+		if numpy is not None:
+			free = numpy.zeros(len(table) + 1, dtype=numpy.int8)
+			free[2:-1] = numpy.frombuffer(table, dtype=table.typecode)[2:] == 0
+			edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], free))))
+			return [(start, end - start) for start, end in zip(edges[0::2].tolist(), edges[1::2].tolist())]
+		extents = []
+		for cluster in xrange(2, len(table)):
+			if table[cluster] == 0:
+				if extents and extents[-1][0] + extents[-1][1] == cluster:
+					extents[-1][1] += 1
+				else:
+					extents.append([cluster, 1])
+		return [tuple(e) for e in extents]
+
+	# Point a directory entry to a new starting cluster, on disk and in entry
+	def set_entry_cluster(self, entry, cluster):
+		hi = cluster >> 16 if self.fat_type == FAT.Type.FAT32 else 0
+		self._write_at(entry["direntry"] + 20, pack("<H", hi))
+		self._write_at(entry["direntry"] + 26, pack("<H", cluster & 0xffff))
+		entry["cluster"] = cluster
+		self.invalidate_dirs()
+
+	# Move the data of a file to the run of free clusters beginning at start,
+	# which must be large enough to hold it. The new chain is written to all
+	# FAT copies, then the directory entry is updated, and only then the old
+	# clusters are freed. The chain must be sound, and be clusters long if
+	# that is given, or ValueError is raised and nothing is written. Note that
+	# cross-links cannot be told from the chain alone, the caller must make
+	# sure no other chain runs into this one. Returns the new chain.
+	def relocate_file(self, entry, start, clusters=None):
+		chain, problem = self.check_cluster_chain(entry["cluster"])
+		if problem is not None:
+			raise ValueError("Chain of %s is damaged: %s" % (entry["name"], problem))
+		elif clusters is not None and len(chain) != clusters:
+			raise ValueError("Chain of %s is %u clusters long, not %u" % (entry["name"], len(chain), clusters))
+		new = range(start, start + len(chain))
+		if self.__fat_table is None:
+			self.load_fat()
+		if new[-1] >= self.__num_clusters + 2:
+			raise ValueError("Clusters %u-%u go past the end of the volume" % (new[0], new[-1]))
+		elif any(self.__fat_table[c] != 0 for c in new):
+			raise ValueError("Clusters %u-%u are not free" % (new[0], new[-1]))
+
+		# Read the whole file, extent by extent, and write it back at once
+		data = bytearray(len(chain) * self.cluster_size())
+		self.__read_extents_into(FAT.chain_to_extents(chain), len(data), data)
+		self._write_at(self.cluster_to_offset(start), data)
+
+		self.write_fat_entries(zip(new, new[1:] + [self.EOF | 0x7]))
+		self.set_entry_cluster(entry, start)
+		self.write_fat_entries([(c, 0) for c in chain])
+		return new
+
+	# Write new files to the directory at path, which must exist, in a single
+	# session. files is a list of (name, size, fp): exactly size bytes are
+	# read from every fp, which is then closed. Every file gets the lowest
+	# run of free clusters it fits in, so files added together end up one
+	# after the other and their data is written in large sequential writes.
+	# Then all the new chains are written to all the FAT copies at once, and
+	# last all the directory entries (with LFN entries where the name is not
+	# a plain 8.3 one), so that an interrupted session leaves at most some
+	# lost clusters behind. Nothing is written unless everything fits.
+	# Returns the directory entries of the new files. fd must be open for
+	# writing.
+	def add_files(self, path, files, now=None):
+		node = self.dir_node(path)
+		csize = self.cluster_size()
+		tenth, time, day = FAT._make_fat_datetime(now or datetime.now())
+
+		# Find where new entries can go, after the last one in use
+		cluster = node.cluster or self.info["root_start_cluster"] or 0
+		slots, end, used = self.__dir_slots(cluster)
+
+		# Names
+		names = []
+		new = set()
+		for name, size, fp in files:
+			if isinstance(name, str):
+				name = name.decode("utf8")
+			if node.lookup(name) is not None or name.lower() in new:
+				raise IOError("File exists: %s" % name.encode("utf8"))
+			new.add(name.lower())
+			sfn, lfn = FAT._make_short_name(name, used)
+			used.add(sfn)
+			names.append((name, sfn, lfn))
+		needed = sum(1 + (len(name) + 12) / 13 if lfn else 1 for name, sfn, lfn in names)
+
+		# Allocate data, then more directory clusters if needed
+		if self.__fat_table is None:
+			self.load_fat()
+		free = [list(e) for e in self.get_free_extents()]
+		starts = []
+		for (name, size, fp), (lname, sfn, lfn) in zip(files, names):
+			count = (size + csize - 1) / csize
+			if count == 0:
+				starts.append(0)
+				continue
+			for e in free:
+				if e[1] >= count:
+					starts.append(e[0])
+					e[0] += count
+					e[1] -= count
+					break
+			else:
+				raise IOError("No contiguous free space for %s" % lname.encode("utf8"))
+		grow = []
+		if needed > len(slots) - end:
+			if not cluster:
+				raise IOError("Root directory is full")
+			dirchain, problem = self.check_cluster_chain(cluster)
+			if problem is not None:
+				raise IOError("Directory %s is damaged: %s" % (path, problem))
+			per_cluster = csize / FAT.DIRSIZE
+			for n in xrange((needed - (len(slots) - end) + per_cluster - 1) / per_cluster):
+				e = next((e for e in free if e[1] > 0), None)
+				if e is None:
+					raise IOError("No free space to grow the directory")
+				grow.append(e[0])
+				e[0] += 1
+				e[1] -= 1
+				first = self.cluster_to_offset(grow[-1])
+				slots.extend(xrange(first, first + csize, FAT.DIRSIZE))
+
+		# Data
+		chunk = FAT.BATCH_READ
+		for start, (name, size, fp), (lname, sfn, lfn) in sorted(zip(starts, files, names), key=lambda f: f[0]):
+			offset = self.cluster_to_offset(start)
+			pos = 0
+			while pos < size:
+				data = fp.read(min(chunk, size - pos))
+				if not data:
+					raise IOError("%s is shorter than %u bytes" % (lname.encode("utf8"), size))
+				self._write_at(offset + pos, data)
+				pos += len(data)
+			fp.close()
+		for c in grow:
+			self._write_at(self.cluster_to_offset(c), "\0" * csize)
+
+		# FAT
+		eof = self.EOF | 7
+		entries = []
+		for start, (name, size, fp) in zip(starts, files):
+			if start:
+				count = (size + csize - 1) / csize
+				entries.extend((c, c + 1) for c in xrange(start, start + count - 1))
+				entries.append((start + count - 1, eof))
+		if grow:
+			chain = [dirchain[-1]] + grow
+			entries.extend(zip(chain, chain[1:]))
+			entries.append((grow[-1], eof))
+		self.write_fat_entries(entries)
+		allocated = sum((size + csize - 1) / csize for name, size, fp in files) + len(grow)
+		self.__update_fsinfo(-allocated)
+
+		# Directory entries, written in runs of contiguous slots
+		raw = []
+		ret = []
+		for start, (name, size, fp), (lname, sfn, lfn) in zip(starts, files, names):
+			if lfn:
+				raw.extend(FAT._make_lfn_entries(lname, sfn))
+			hi = start >> 16 if self.fat_type == FAT.Type.FAT32 else 0
+			raw.append(FAT._DIRENT.pack(sfn, FAT.Attribute.ARCHIVE, tenth, time, day, day, hi,
+				time, day, start & 0xffff, size))
+			ret.append(FAT.DirEntry(lname, FAT.Attribute.ARCHIVE, start, size, slots[end + len(raw) - 1],
+				tenth, time, day, day, time, day))
+		i = 0
+		while i < len(raw):
+			j = i + 1
+			while j < len(raw) and slots[end + j] == slots[end + j - 1] + FAT.DIRSIZE:
+				j += 1
+			self._write_at(slots[end + i], "".join(raw[i:j]))
+			i = j
+		self.invalidate_dirs()
+		return ret
+
+	# Offsets of all the entries of the directory at the given cluster (0 for
+	# the FAT12/16 root directory), the index of the first one after the last
+	# in use, and the set of short names in use
+	def __dir_slots(self, cluster):
+		slots = []
+		end = None
+		used = set()
+		for offset, buf in self.__read_dir_pieces(cluster):
+			for pos in xrange(0, len(buf) - FAT.DIRSIZE + 1, FAT.DIRSIZE):
+				slots.append(offset + pos)
+				if end is not None:
+					continue
+				first = buf[pos]
+				if first == '\x00':
+					end = len(slots) - 1
+				elif first != '\xe5' and ord(buf[pos + 11]) & FAT.Attribute.LONGNAME != FAT.Attribute.LONGNAME:
+					used.add(str(buf[pos:pos + 11]))
+		return slots, len(slots) if end is None else end, used
+
+	# Characters allowed in short names, besides letters and digits
+	_SFN_CHARS = "$%'-_@~`!(){}^#&"
+
+	# Returns the short name for name, in its 11-byte form, that does not
+	# clash with those in used, and whether an LFN is needed as well
+	@staticmethod
+	def _make_short_name(name, used):
+		def clean(s):
+			return "".join(c if c.isalnum() or c in FAT._SFN_CHARS else "_"
+				for c in s.upper().encode("ascii", "replace").replace("?", "_") if c not in " .")
+		base, dot, ext = name.rpartition(".")
+		if not dot:
+			base, ext = name, ""
+		sbase, sext = clean(base), clean(ext)
+		if 0 < len(base) <= 8 and len(ext) <= 3 and sbase == base and sext == ext:
+			sfn = str(base.ljust(8) + ext.ljust(3))
+			if sfn not in used:
+				return sfn, False
+		sbase = sbase or "_"
+		for n in xrange(1, 1000000):
+			tail = "~%d" % n
+			sfn = (sbase[:8 - len(tail)] + tail).ljust(8) + sext[:3].ljust(3)
+			if sfn not in used:
+				return sfn, True
+		raise IOError("No short name available for %s" % name.encode("utf8"))
+
+	# LFN entries for name, given its 11-byte short name, last to first as
+	# they are stored
+	@staticmethod
+	def _make_lfn_entries(name, sfn):
+		chars = name.encode("utf-16-le")
+		if len(name) % 13:
+			chars += "\0\0"
+			chars += "\xff" * (-len(chars) % 26)
+		csum = FAT._calc_checksum(sfn)
+		count = len(chars) / 26
+		entries = []
+		for seq in xrange(count, 0, -1):
+			c = chars[(seq - 1) * 26:seq * 26]
+			entries.append(pack("<B10sBBB12sH4s", seq | (0x40 if seq == count else 0), c[0:10],
+				FAT.Attribute.LONGNAME, 0, csum, c[10:22], 0, c[22:26]))
+		return entries
+
+	# Adjust the free cluster count in the FAT32 FSInfo sector, if valid
+	def __update_fsinfo(self, delta):
+		if self.fat_type != FAT.Type.FAT32:
+			return
+		sector = unpack_from("<H", self._read_at(self.__start + 0x30, 2))[0]
+		if sector == 0 or sector == 0xffff:
+			return
+		offset = self.__start + sector * self.info["sector_size"]
+		sig1, sig2, free = unpack_from("<L480xLL", self._read_at(offset, 488 + 4))
+		if sig1 != 0x41615252 or sig2 != 0x61417272 or free == 0xffffffff:
+			return
+		self._write_at(offset + 488, pack("<L", max(free + delta, 0)))
+
+	# If load is False, a FAT loaded lazily is not loaded for this walk, e.g.
+	# when only a single file is wanted
+	def get_cluster_chain(self, cluster, load=True):
 		chain = [cluster]
 		if cluster == 0:
 			return chain
+		if self.__fat_table is None and self.__lazy_fat and load:
+			self.load_fat()
 		while cluster < self.EOF:
 			chain.append(self.__next_cluster(cluster))
 			cluster = chain[-1]
 		return chain[:-1]
 
+	# Walk the chain starting at cluster like get_cluster_chain(), but stop at
+	# anything that cannot be part of a sound chain (free, reserved or bad
+	# clusters, clusters outside the volume, loops). Returns the chain walked
+	# so far and a description of the problem, None if the chain is sound.
+	def check_cluster_chain(self, cluster):
+		last = self.__num_clusters + 1
+		if cluster < 2 or cluster > last:
+			return [], "starts at invalid cluster %u" % cluster
+		if self.__fat_table is None and self.__lazy_fat:
+			self.load_fat()
+		chain = [cluster]
+		seen = set(chain)
+		while True:
+			nxt = self.__next_cluster(cluster)
+			if nxt >= self.EOF:
+				return chain, None
+			elif nxt == 0:
+				return chain, "cluster %u is free" % cluster
+			elif nxt == self.BAD:
+				return chain, "cluster %u is bad" % cluster
+			elif nxt < 2 or nxt > last:
+				return chain, "cluster %u points to invalid cluster %u" % (cluster, nxt)
+			elif nxt in seen:
+				return chain, "loop at cluster %u" % nxt
+			chain.append(nxt)
+			seen.add(nxt)
+			cluster = nxt
+
+	# Coalesce a cluster chain into extents, i.e. (start_cluster, run_length)
+	# runs of contiguous clusters
+	@staticmethod
+	def chain_to_extents(chain):
+		extents = []
+		for c in chain:
+			if extents and extents[-1][0] + extents[-1][1] == c:
+				extents[-1][1] += 1
+			else:
+				extents.append([c, 1])
+		return [tuple(e) for e in extents]
+
+	# Same as get_cluster_chain(), but as a list of extents
+	def get_cluster_extents(self, cluster, load=True):
+		if cluster < 2:
+			return []
+		return FAT.chain_to_extents(self.get_cluster_chain(cluster, load))
+
 	def read_cluster(self, cluster):
 		if cluster < 2:
 			return ""
-		self.fd.seek(self.cluster_to_offset(cluster))
-		return self.fd.read(self.info["sectors_per_cluster"] * self.info["sector_size"])
+		return self._read_at(self.cluster_to_offset(cluster), self.cluster_size())
+
+	def cluster_size(self):
+		return self.info["sectors_per_cluster"] * self.info["sector_size"]
 
 	# Calculate the logical sector number from the cluster
 	def cluster_to_offset(self, cluster):
@@ -127,7 +1129,7 @@ class FAT(object):
 
 	# Read everything we need from the bootsector
 	def __parse_bootsector(self):
-		data = unpack("<3x8sHBHBHHBHHHLL LHHL", self.fd.read(48))
+		data = unpack_from("<3x8sHBHBHHBHHHLL LHHL", self._read_at(self.__start, 48))
 		return {
 			"oem": data[0].strip(" "),
 			"sector_size": data[1],		# Bytes per sector 0x0B
@@ -147,20 +1149,30 @@ class FAT(object):
 		}
 
 	# Convert a FAT date to a date object
-	def __parse_fat_date(self, v):
+	@staticmethod
+	def _parse_fat_date(v):
 		year, month, day = 1980 + (v >> 9), (v >> 5) & 0x1f, v & 0x1f
 		month = min(max(month, 12), 1)
 		day = min(max(day, 31), 1)
 		return date(year, month, day)
 
+	# Convert a datetime object to a FAT timestamp, as (tenths, time, date)
+	@staticmethod
+	def _make_fat_datetime(dt):
+		tenth = (dt.second & 1) * 100 + dt.microsecond / 10000
+		time = (dt.hour << 11) | (dt.minute << 5) | (dt.second / 2)
+		day = ((dt.year - 1980) << 9) | (dt.month << 5) | dt.day
+		return tenth, time, day
+
 	# Convert a FAT timestamp to a datetime object
-	def __parse_fat_datetime(self, v1, v2, v3):
+	@staticmethod
+	def _parse_fat_datetime(v1, v2, v3):
 		hour, minute, second = v2 >> 11 & 0x1f, v2 >> 16 & 0x3f, (v2 & 0x1f) * 2
 		if v1 >= 100:
 			second += 1
 			v1 -= 100
 		usec = v1 * 10000
-		d = self.__parse_fat_date(v3)
+		d = FAT._parse_fat_date(v3)
 		#~ print "DT = ", (d.year, d.month, d.day, hour, minute, second, usec)
 		return datetime(d.year, d.month, d.day, hour, minute, second, usec)
 
@@ -192,26 +1204,38 @@ class FAT(object):
 			bas[-1] = bas[-1][:-2]
 		lfn = "".join (ba.decode ("utf16") for ba in bas)	# UCS-2 is UTF-16
 		return {
-			"name": lfn if lfn is not None and len (lfn) > 0 else self.__normalize_name(de[0]),
+			"name": lfn if lfn is not None and len (lfn) > 0 else self.__normalize_name(de[0], ord(buf[12])),
 			"attributes": de[1],
-			"created": self.__parse_fat_datetime(de[2], de[3], de[4]),
-			"last_accessed": self.__parse_fat_date(de[5]),
-			"modified": self.__parse_fat_datetime(0, de[6], de[7]),
+			"created": self._parse_fat_datetime(de[2], de[3], de[4]),
+			"last_accessed": self._parse_fat_date(de[5]),
+			"modified": self._parse_fat_datetime(0, de[6], de[7]),
 			"cluster": de[8],
 			"size": de[9],
 			"direntry": self.fd.tell() - FAT.DIRSIZE
 		}
 
-	# Normalizes a 8.3 FAT filename
-	def __normalize_name(self, fatname):
-		if fatname[8:] == "   ":
+	# Normalizes a 8.3 FAT filename. flags is byte 12 of the directory entry,
+	# where Windows NT marks names that are to be shown in lowercase. Names
+	# with non-ASCII characters are decoded from the OEM codepage, like Linux
+	# does by default, so that they can be joined and compared with LFNs.
+	def __normalize_name(self, fatname, flags=0):
+		if any(c >= "\x80" for c in fatname):
+			fatname = fatname.decode(FAT.OEM_CODEPAGE)
+		base = fatname[:8].strip(" ")
+		ext = fatname[8:].strip(" ")
+		if flags & FAT.NT_LOWER_BASE:
+			base = base.lower()
+		if flags & FAT.NT_LOWER_EXT:
+			ext = ext.lower()
+		if not ext:
 			# Skip the dot if there is no file extension
-			return fatname[:8].strip(" ")
+			return base
 		else:
-			# Otherwise strip the spaces and dotify plus the extension
-			return fatname[:8].strip(" ") + "." + fatname[8:].strip(" ")
+			# Otherwise dotify plus the extension
+			return base + "." + ext
 
-	def _calc_checksum (self, filename):
+	@staticmethod
+	def _calc_checksum (filename):
 		s = 0
 		for c in filename:
 			s = ((s & 1) << 7) + (s >> 1) + ord (c)
@@ -236,112 +1260,266 @@ class FAT(object):
 				items.append(de)
 		return items
 
-	# For FAT32
+	# Raw contents of a directory, as (absolute offset, buffer) pieces, one
+	# per extent. Cluster 0 stands for the root directory, which has a fixed
+	# location on FAT12/16.
+	def __read_dir_pieces(self, stClu):
+		if not stClu:
+			if self.info["root_start_cluster"] is None:
+				yield self.__root_dir, self._read_at(self.__root_dir, self.info["root_entries"] * FAT.DIRSIZE)
+				return
+			stClu = self.info["root_start_cluster"]
+		csize = self.cluster_size()
+		for start, count in self.get_cluster_extents(stClu):
+			offset = self.cluster_to_offset(start)
+			yield offset, self._read_at(offset, count * csize)
+
 	def __read_dir(self, stClu):
 		items = []
-		bas = []
+		lfn = []
 		csum = None
-		for clu in self.get_cluster_chain (stClu):
-			offset = self.cluster_to_offset (clu)
-			#~ print "Seeking to %u" % offset
-			self.fd.seek(offset, SEEK_SET)
-			nEnt = self.info["sectors_per_cluster"] * self.info["sector_size"] / FAT.DIRSIZE
-			#~ print "Dir entries per clu: %d" % nEnt
-			for i in xrange (0, nEnt):
-				buf = self.fd.read(FAT.DIRSIZE)
-				assert len (buf) == FAT.DIRSIZE
-
-				# Unpack according to dir entry structure
-				de = unpack("<11sBxBHHH2xHHHL", buf)
-				if ord (de[0][0]) == 0xE5:
+		nextLfnSeqNo = None
+		dirent = FAT._DIRENT
+		fat32 = self.fat_type == FAT.Type.FAT32
+		for offset, buf in self.__read_dir_pieces(stClu):
+			for pos in xrange(0, len(buf) - FAT.DIRSIZE + 1, FAT.DIRSIZE):
+				first = buf[pos]
+				if first == '\x00':
+					# First blank filename, end of directory, quit
+					return items
+				elif first == '\xe5':
 					# Deleted file, skip
-					pass
-				elif de[1] & FAT.Attribute.LABEL and not de[1] & FAT.Attribute.READONLY:
-					# Volume label, skip
-					pass
-				elif de[1] & FAT.Attribute.LONGNAME == FAT.Attribute.LONGNAME:
-					# LFN entry
-					de = unpack("<%uB" % FAT.DIRSIZE, buf)	# Re-unpack as single bytes
+					continue
 
-					if de[0] & 0x40:
+				# Unpack according to dir entry structure
+				de = dirent.unpack_from(buf, pos)
+				attributes = de[1]
+				if attributes & FAT.Attribute.LONGNAME == FAT.Attribute.LONGNAME:
+					# LFN entry, fragments are stored last to first
+					seq = ord(first)
+					if seq & 0x40:
 						# First lfn entry, clear list
-						bas = []
-						nextLfnSeqNo = (de[0] & ~0x40) - 1
-					elif de[0] == nextLfnSeqNo:
+						lfn = []
+						nextLfnSeqNo = (seq & ~0x40) - 1
+					elif seq == nextLfnSeqNo:
 						nextLfnSeqNo -= 1
 						assert nextLfnSeqNo >= 0
 					else:
-						self._logger.warning ("Bad LFN Sequence No.: expected %u, found %u", nextLfnSeqNo, de[0])
-
-					ba = bytearray (de[1:11] + de[14:26] + de[28:32])
-					csum = de[13]
-					#~ print nextLfnSeqNo + 1, csum
-					bas.insert (0, ba)	# Prepend
-				elif de[0][0] == '\x00':
-					# First blank filename, end of directory, quit
-					#~ print "--EOD--"
-					break
+						self._logger.warning ("Bad LFN Sequence No.: expected %u, found %u", nextLfnSeqNo, seq)
+					lfn.append(buf[pos + 1:pos + 11] + buf[pos + 14:pos + 26] + buf[pos + 28:pos + 32])
+					csum = ord(buf[pos + 13])
+				elif attributes & FAT.Attribute.LABEL and not attributes & FAT.Attribute.READONLY:
+					# Volume label, skip
+					pass
 				else:
 					# Normal file/subdir entry
-					if csum is not None:
+					name = None
+					if lfn:
 						# Verify that LFN matches file
-						c = self._calc_checksum (de[0])
-						if c != csum:
+						if self._calc_checksum (de[0]) != csum:
 							self._logger.error ("LFN checksum does not match")
+						# UCS-2 is UTF-16, name is terminated by 0x0000 and
+						# padded with 0xFFFF
+						lfn.reverse()
+						name = "".join(lfn).decode("utf-16-le")
+						end = name.find(u"\0")
+						name = name[:end] if end >= 0 else name.rstrip(u"\uffff")
+						lfn = []
 						csum = None
 
-					# Remove any trailing 0xFFFF in any LFN component
-					bas = map (lambda ba: ba.rstrip('\xffff'), bas)
-					#~ print bas
-
-					# Remove trailing 0x0000 in last LFN component
-					if len (bas) > 0 and bas[-1][-1] == 0x00 and bas[-1][-2] == 0x00:
-						bas[-1] = bas[-1][:-2]
-					lfn = "".join (ba.decode ("utf16") for ba in bas)	# UCS-2 is UTF-16
-					dirent = {
-						"name": lfn if lfn is not None and len (lfn) > 0 else self.__normalize_name(de[0]),
-						"attributes": de[1],
-						"created": self.__parse_fat_datetime(de[2], de[3], de[4]),
-						"last_accessed": self.__parse_fat_date(de[5]),
-						"modified": self.__parse_fat_datetime(0, de[6], de[7]),
-						"cluster": de[8],
-						"size": de[9],
-						"direntry": self.fd.tell() - FAT.DIRSIZE
-					}
-					#~ print dirent["name"]
-					items.append(dirent)
-
+					# The high word of the cluster is only meaningful on FAT32
+					cluster = de[9] | (de[6] << 16) if fat32 else de[9]
+					items.append(FAT.DirEntry(name if name else self.__normalize_name(de[0], ord(buf[pos + 12])),
+						attributes, cluster, de[10], offset + pos, de[2], de[3], de[4], de[5], de[7], de[8]))
 		return items
 
+	# Identity of the volume: a hash of the boot sector, which holds the
+	# serial number, label and geometry
+	def volume_id(self):
+		return hashlib.sha1(self._read_at(self.__start, self.info["sector_size"])).hexdigest()
+
+	# Hash of a directory, covering both its cluster chain and its contents
+	# (cluster 0 is the root directory)
+	def dir_digest(self, cluster):
+		h = hashlib.sha1()
+		for offset, buf in self.__read_dir_pieces(cluster):
+			h.update(str(offset))
+			h.update(buf)
+		return h.hexdigest()
+
+	# Hash of the active FAT
+	def fat_digest(self):
+		return hashlib.sha1(self.__read_fat_bytes()).hexdigest()
+
+	# Hash of the contents of many directories at once, given as a dict
+	# mapping their starting cluster to their chain (an empty one for the
+	# root directory when it has a fixed location). Chains are read in a
+	# single pass, see read_chains(). They are not checked against the FAT,
+	# which is not even loaded: see fat_digest() to tell if it changed.
+	def dirs_digest(self, chains):
+		csize = self.cluster_size()
+		digests = {}
+		items = []
+		for cluster, chain in chains.iteritems():
+			if chain:
+				items.append((cluster, chain, len(chain) * csize))
+			else:
+				digests[cluster] = self.dir_digest(cluster)
+		for cluster, data in self.read_chains(items):
+			digests[cluster] = hashlib.sha1(data).hexdigest()
+		return hashlib.sha1(repr(sorted(digests.iteritems()))).hexdigest()
+
 	def get_label(self):
 		# FIXME: Is the label always located as the first file in the root directory?
-		self.fd.seek(self.__root_dir, SEEK_SET)
-		return unpack("11s", self.fd.read(11))[0].strip(" ")
+		return unpack_from("11s", self._read_at(self.__root_dir, 11))[0].strip(" ")
 
-	def read_file(self, path):
-		path = path.lower()
+	def __find_file(self, path):
 		pos = path.rfind("/")
-		items = self.read_dir("" if pos < 0 else path[:pos])
-		if items:
-			items = filter(lambda x: x["name"].lower() == path[pos+1:], items)
-			if items:
-				item = items[0]
-				data = "".join([self.read_cluster(c) for c in self.get_cluster_chain(item["cluster"])])
-				return data[:item["size"]]
-		raise FAT.FileNotFoundError(path)
-
-	# Read all files from a directory
+		entry = self.dir_node("" if pos < 0 else path[:pos]).lookup(path[pos + 1:])
+		if entry is None:
+			raise FAT.FileNotFoundError(path)
+		return FAT.DirEntry(*entry.fields())
+
+	# Read a whole file, as a string
+	def read_file(self, path):
+		return str(self.read_file_view(path))
+
+	# Read a whole file without copying it where possible. When the device is
+	# mapped and the file is contiguous this is a view into the mapping,
+	# which can no longer be accessed after close(), otherwise the data is
+	# read into a bytearray of the final size, with a single read per extent.
+	def read_file_view(self, path):
+		item = self.__find_file(path)
+		extents = self.get_cluster_extents(item["cluster"])
+		size = item["size"]
+		if self.__mmap is not None and len(extents) == 1:
+			return self._read_at(self.cluster_to_offset(extents[0][0]), size)
+		data = bytearray(size)
+		self.__read_extents_into(extents, size, data)
+		return data
+
+	# Open a file for streaming, see FAT.File. Files can only be opened for
+	# writing if fd is writable.
+	def open(self, path, readahead=0, writable=False):
+		item = self.__find_file(path)
+		if item["attributes"] & FAT.Attribute.DIRECTORY:
+			raise IOError("Is a directory: %s" % path)
+		return FAT.File(self, item, readahead, writable)
+
+	# Read a whole file into buf, which must be a writable buffer (e.g. a
+	# bytearray) at least as large as the file. Returns the number of bytes
+	# read.
+	def read_into(self, path, buf):
+		item = self.__find_file(path)
+		if len(buf) < item["size"]:
+			raise ValueError("Buffer too small for %s (%u bytes)" % (path, item["size"]))
+		return self.__read_extents_into(self.get_cluster_extents(item["cluster"]), item["size"], buf)
+
+	def __read_extents_into(self, extents, size, buf):
+		view = memoryview(buf)
+		csize = self.cluster_size()
+		pos = 0
+		for start, count in extents:
+			if pos >= size:
+				break
+			n = min(count * csize, size - pos)
+			offset = self.cluster_to_offset(start)
+			if self.__mmap is None and hasattr(self.fd, "readinto"):
+				self.fd.seek(offset, SEEK_SET)
+				got = self.fd.readinto(view[pos:pos + n])
+			else:
+				chunk = self._read_at(offset, n)
+				got = len(chunk)
+				view[pos:pos + got] = chunk
+			pos += got
+			if got < n:
+				break
+		return pos
+
+	# Read many files at once, yielding (path, data) as each one is complete,
+	# data being as returned by read_file_view(). All paths are resolved before
+	# reading anything, then see read_chains().
+	def read_files(self, paths):
+		items = []
+		for path in paths:
+			item = self.__find_file(path)
+			items.append((path, self.get_cluster_chain(item["cluster"]), item["size"]))
+		return self.read_chains(items)
+
+	# Read the data of many cluster chains at once. items is a list of
+	# (key, chain, size), (key, data) is yielded as each chain is complete,
+	# data being a bytearray of the given size, or a view into the mapping
+	# for contiguous chains when the device is mapped. Whatever is beyond the
+	# end of the chain reads as zeros.
+	# The extents of all chains are read in order of their position on the
+	# device, and those close enough merged into reads of at most BATCH_READ
+	# bytes, even across chains. Files laid out one after the other are then
+	# read in a single sequential pass. Chains are yielded in the order they
+	# complete.
+	def read_chains(self, items):
+		csize = self.cluster_size()
+		pieces = []
+		remaining = []
+		short = []
+		for n, (key, chain, size) in enumerate(items):
+			pos = 0
+			first = len(pieces)
+			for start, count in FAT.chain_to_extents(chain):
+				if pos >= size:
+					break
+				length = min(count * csize, size - pos)
+				pieces.append((self.cluster_to_offset(start), count * csize, length, n, pos))
+				pos += length
+			remaining.append(len(pieces) - first)
+			short.append(pos < size)
+		pieces.sort()
+
+		bufs = [None] * len(items)
+		for n, left in enumerate(remaining):
+			if left == 0:
+				yield items[n][0], bytearray(items[n][2])
+		i = 0
+		while i < len(pieces):
+			offset, span, length, idx, pos = pieces[i]
+			if self.__mmap is not None and remaining[idx] == 1 and pos == 0 and not short[idx]:
+				# Contiguous chain, nothing to copy
+				remaining[idx] = 0
+				yield items[idx][0], self._read_at(offset, length)
+				i += 1
+				continue
+
+			# Merge the following pieces while they are close enough
+			end = offset + span
+			j = i + 1
+			while j < len(pieces):
+				start, span = pieces[j][0], pieces[j][1]
+				if start - end > FAT.BATCH_GAP or max(end, start + span) - offset > FAT.BATCH_READ:
+					break
+				end = max(end, start + span)
+				j += 1
+			data = self._read_at(offset, end - offset)
+			for piece_offset, span, piece_length, idx, pos in pieces[i:j]:
+				if bufs[idx] is None:
+					bufs[idx] = bytearray(items[idx][2])
+				rel = piece_offset - offset
+				chunk = data[rel:rel + piece_length]
+				bufs[idx][pos:pos + len(chunk)] = chunk
+				remaining[idx] -= 1
+				if remaining[idx] == 0:
+					yield items[idx][0], bufs[idx]
+					bufs[idx] = None
+			i = j
+
+	# Read all files from the directory starting at the given cluster (0 for
+	# the root directory)
+	def read_dir_cluster(self, cluster):
+		return self.__read_dir(cluster)
+
+	# Read all files from a directory. Directories are only parsed once, see
+	# dir_node(), the entries returned are copies that callers can modify.
 	def read_dir(self, path=""):
-		# Start with the root directory
-		items = self.__read_dir(self.info["root_start_cluster"])
-		#~ print "->", items
-		# Filter out empty strings
-		subdirs = filter(len, path.lower().split("/"))
-		# Now look in all sub directories for our path
-		for d in subdirs:
-			# Get the one and only directory we are looking for
-			items = filter(lambda x: x["attributes"] & FAT.Attribute.DIRECTORY and x["name"].lower() == d, items)
-			if not items:
-				raise FAT.FileNotFoundError(path)
-			items = self.__read_dir(items[0]["cluster"])
-		return items
+		return [FAT.DirEntry(*e.fields()) for e in self.dir_node(path).entries()]
+
+# Nested classes can't be pickled by name, so rebuild entries through this
+def _dir_entry(*fields):
+	return FAT.DirEntry(*fields)
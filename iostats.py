@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+# I/O instrumentation: counts what goes through the files used by FAT and
+# Selector and times the phases of a run. Nothing here is used unless an
+# IOStats instance is passed in, so there is no overhead otherwise.
+
+import sys
+import json
+import timeit
+from collections import OrderedDict
+
+class IOStats (object):
+	COUNTERS = (
+		"syscalls",			# All calls that reach the OS: reads, writes, seeks, flushes, mappings
+		"seeks",
+		"reads",
+		"bytes_read",
+		"writes",
+		"bytes_written",
+		"mapped_reads",		# Reads served from a memory mapping, no syscall involved
+		"mapped_bytes",
+		"mapped_writes",	# Writes to a memory mapping
+		"mapped_bytes_written",
+		"cache_hits",		# Directories reused from the scan cache
+		"cache_misses",		# Directories that had to be parsed
+		"block_cache_hits",	# Blocks served by the block cache, see blockcache.py
+		"block_cache_misses",
+	)
+
+	def __init__ (self):
+		self.counters = OrderedDict ((name, 0) for name in IOStats.COUNTERS)
+		self.phases = OrderedDict ()
+
+	def count (self, name, n = 1):
+		self.counters[name] += n
+
+	def phase (self, name):
+		"""Returns a context manager timing what runs inside it as the given
+		phase. Phases that run more than once add up."""
+		return _Phase (self, name)
+
+	def wrap (self, fp):
+		"""Returns a file object that counts everything done through fp"""
+		return CountingFile (fp, self)
+
+	def instrumentFat (self, fat):
+		"""Counts the reads and writes a FAT instance serves from its memory
+		mapping, which do not go through its file object"""
+		readAt = fat._read_at
+		writeAt = fat._write_at
+		def countedReadAt (offset, size):
+			data = readAt (offset, size)
+			if fat.mapped ():
+				self.counters["mapped_reads"] += 1
+				self.counters["mapped_bytes"] += len (data)
+			return data
+		def countedWriteAt (offset, data):
+			writeAt (offset, data)
+			if fat.mapped ():
+				self.counters["mapped_writes"] += 1
+				self.counters["mapped_bytes_written"] += len (data)
+		fat._read_at = countedReadAt
+		fat._write_at = countedWriteAt
+
+	def asDict (self):
+		return {
+			"counters": dict (self.counters),
+			"phases": dict (self.phases),
+		}
+
+	def report (self, fp = None):
+		# Resolved here, as sys.stdout is redirected in batch mode
+		fp = fp or sys.stdout
+		print >> fp, "I/O:"
+		for name, value in self.counters.iteritems ():
+			print >> fp, "  %-20s %12d" % (name, value)
+		if self.phases:
+			print >> fp, "Phases:"
+			for name, t in self.phases.iteritems ():
+				print >> fp, "  %-20s %9.3f ms" % (name, t * 1000)
+			print >> fp, "  %-20s %9.3f ms" % ("total", sum (self.phases.itervalues ()) * 1000)
+
+	def reportJson (self, fp = None):
+		fp = fp or sys.stdout
+		json.dump (self.asDict (), fp, indent = 2, sort_keys = True, separators = (",", ": "))
+		print >> fp
+
+class NullStats (object):
+	"""Stands in for IOStats when instrumentation is disabled, doing nothing"""
+	def count (self, name, n = 1):
+		pass
+
+	def phase (self, name):
+		return _NULL_PHASE
+
+	def wrap (self, fp):
+		return fp
+
+	def instrumentFat (self, fat):
+		pass
+
+	def __nonzero__ (self):
+		return False
+
+class _Phase (object):
+	def __init__ (self, stats, name):
+		self.stats = stats
+		self.name = name
+
+	def __enter__ (self):
+		self.start = timeit.default_timer ()
+
+	def __exit__ (self, *args):
+		t = timeit.default_timer () - self.start
+		self.stats.phases[self.name] = self.stats.phases.get (self.name, 0.0) + t
+
+class _NullPhase (object):
+	def __enter__ (self):
+		pass
+
+	def __exit__ (self, *args):
+		pass
+
+_NULL_PHASE = _NullPhase ()
+
+NULL = NullStats ()
+
+class CountingFile (object):
+	"""Wraps a file object counting seeks, reads, writes and bytes moved.
+	Anything else is passed through to the wrapped file."""
+
+	def __init__ (self, fp, stats):
+		self._fp = fp
+		self._stats = stats.counters
+
+	def read (self, size = -1):
+		data = self._fp.read (size)
+		c = self._stats
+		c["syscalls"] += 1
+		c["reads"] += 1
+		c["bytes_read"] += len (data)
+		return data
+
+	def readinto (self, buf):
+		n = self._fp.readinto (buf)
+		c = self._stats
+		c["syscalls"] += 1
+		c["reads"] += 1
+		c["bytes_read"] += n or 0
+		return n
+
+	def write (self, data):
+		self._fp.write (data)
+		c = self._stats
+		c["syscalls"] += 1
+		c["writes"] += 1
+		c["bytes_written"] += len (data)
+
+	def seek (self, offset, whence = 0):
+		self._fp.seek (offset, whence)
+		c = self._stats
+		c["syscalls"] += 1
+		c["seeks"] += 1
+
+	def flush (self):
+		self._fp.flush ()
+		self._stats["syscalls"] += 1
+
+	def fileno (self):
+		# Whoever asks is most likely about to map the file
+		self._stats["syscalls"] += 1
+		return self._fp.fileno ()
+
+	def __getattr__ (self, name):
+		return getattr (self._fp, name)
+
+	def __enter__ (self):
+		return self
+
+	def __exit__ (self, *args):
+		self._fp.close ()
+
+	def __iter__ (self):
+		return iter (self._fp)
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+
+# Synthetic FAT12/16/32 image generator, mainly useful to exercise fat.py and
+# selector.py without a physical stick
+
+import sys
+import struct
+import random
+import argparse
+
+from fat import FAT
+
+# Same layout as the records selector.py reads
+SELECTOR_SIZE = 901120
+SELECTOR_STATS_OFFSET = 0x29416
+SELECTOR_REC_OFFSET = 0x29880
+SELECTOR_REC_SIZE = 128
+SELECTOR_MAX_SLOTS = 999
+
+ADF_SIZE = 901120
+
+class ImageError (Exception):
+	pass
+
+class _Node (object):
+	def __init__ (self, name, isDir, data = None, fragments = 1):
+		self.name = name
+		self.isDir = isDir
+		self.data = data
+		self.fragments = fragments
+		self.children = []
+		self.shortName = None
+		self.lfn = []
+		self.clusters = []
+
+class ImageBuilder (object):
+	"""Builds a FAT image from a tree of directories and files kept in memory"""
+
+	# Minimum and maximum number of clusters for every FAT type
+	LIMITS = {
+		FAT.Type.FAT12: (16, 4084),
+		FAT.Type.FAT16: (4085, 65524),
+		FAT.Type.FAT32: (65525, 0x0ffffff5),
+	}
+
+	def __init__ (self, fatType = FAT.Type.FAT32, sectorsPerCluster = 8, sectorSize = 512, numFats = 2,
+			rootEntries = 512, label = "GOTEK", serial = 0x12345678, seed = 0):
+		self.fatType = fatType
+		self.sectorsPerCluster = sectorsPerCluster
+		self.sectorSize = sectorSize
+		self.numFats = numFats
+		self.rootEntries = rootEntries if fatType != FAT.Type.FAT32 else 0
+		self.label = label
+		self.serial = serial
+		self.root = _Node ("", True)
+		self.random = random.Random (seed)
+
+	@property
+	def clusterSize (self):
+		return self.sectorsPerCluster * self.sectorSize
+
+	def _lookup (self, path, create = False):
+		node = self.root
+		for part in filter (len, path.split ("/")):
+			found = [c for c in node.children if c.name.lower () == part.lower ()]
+			if found:
+				node = found[0]
+				if not node.isDir:
+					raise ImageError ("Not a directory: %s" % path)
+			elif create:
+				child = _Node (part, True)
+				node.children.append (child)
+				node = child
+			else:
+				raise ImageError ("No such directory: %s" % path)
+		return node
+
+	def mkdir (self, path):
+		return self._lookup (path, True)
+
+	def add_file (self, path, data, fragments = 1):
+		"""Adds a file, split into the given number of non-contiguous extents"""
+		pos = path.rfind ("/")
+		parent = self._lookup (path[:pos] if pos >= 0 else "", True)
+		parent.children.append (_Node (path[pos + 1:], False, data, fragments))
+
+	# Short names and LFN entries are made the way FAT.add_files () makes them
+	def _assign_short_names (self, node):
+		used = set ()
+		names = set ()
+		for child in node.children:
+			name = child.name.decode ("utf8") if isinstance (child.name, str) else child.name
+			if name.lower () in names:
+				raise ImageError ("Duplicate name: %s" % name.encode ("utf8"))
+			names.add (name.lower ())
+			sfn, lfn = FAT._make_short_name (name, used)
+			used.add (sfn)
+			child.shortName = sfn
+			child.lfn = FAT._make_lfn_entries (name, sfn) if lfn else []
+			if child.isDir:
+				self._assign_short_names (child)
+
+	@staticmethod
+	def _short_entry (sfn, attributes, cluster, size):
+		# 2016-03-14 12:00:00
+		time = (12 << 11)
+		date = ((2016 - 1980) << 9) | (3 << 5) | 14
+		return struct.pack ("<11sBBBHHHHHHHL", sfn, attributes, 0, 0, time, date, date,
+			cluster >> 16, time, date, cluster & 0xFFFF, size)
+
+	def _num_entries (self, node):
+		n = 0 if node is self.root else 2
+		if node is self.root and self.label:
+			n += 1
+		for child in node.children:
+			n += 1
+			n += len (child.lfn)
+		return n + 1	# Terminator
+
+	def _clusters_for (self, nbytes):
+		return max (1, (nbytes + self.clusterSize - 1) / self.clusterSize)
+
+	def _walk (self, node):
+		yield node
+		for child in node.children:
+			if child.isDir:
+				for n in self._walk (child):
+					yield n
+			else:
+				yield child
+
+	def _plan (self):
+		"""Returns a list of (node, nClusters, fragments) in allocation order"""
+		plan = []
+		for node in self._walk (self.root):
+			if node.isDir:
+				if node is self.root and self.fatType != FAT.Type.FAT32:
+					continue
+				plan.append ((node, self._clusters_for (self._num_entries (node) * FAT.DIRSIZE), 1))
+			elif len (node.data) > 0:
+				plan.append ((node, self._clusters_for (len (node.data)), node.fragments))
+		return plan
+
+	def _allocate (self, plan):
+		nxt = 2
+		for node, n, fragments in plan:
+			fragments = max (1, min (fragments, n))
+			node.clusters = []
+			per = n / fragments
+			for i in xrange (fragments):
+				cnt = per if i < fragments - 1 else n - per * (fragments - 1)
+				node.clusters.extend (xrange (nxt, nxt + cnt))
+				nxt += cnt
+				if i < fragments - 1:
+					# Leave a one-cluster hole
+					nxt += 1
+		return nxt - 2
+
+	def _fat_bytes (self, nClusters):
+		entries = nClusters + 2
+		if self.fatType == FAT.Type.FAT12:
+			return (entries * 3 + 1) / 2
+		elif self.fatType == FAT.Type.FAT16:
+			return entries * 2
+		else:
+			return entries * 4
+
+	def _layout (self, minClusters):
+		lo, hi = ImageBuilder.LIMITS[self.fatType]
+		nClusters = max (minClusters, lo)
+		if nClusters > hi:
+			raise ImageError ("Contents do not fit in a FAT%d volume with this cluster size" % {1: 12, 2: 16, 3: 32}[self.fatType])
+		self.reserved = 32 if self.fatType == FAT.Type.FAT32 else 1
+		self.sectorsPerFat = (self._fat_bytes (nClusters) + self.sectorSize - 1) / self.sectorSize
+		self.rootSectors = (self.rootEntries * FAT.DIRSIZE + self.sectorSize - 1) / self.sectorSize
+		self.numClusters = nClusters
+		self.totalSectors = self.reserved + self.numFats * self.sectorsPerFat + self.rootSectors + nClusters * self.sectorsPerCluster
+
+	def _bootsector (self):
+		bs = bytearray (self.sectorSize)
+		total16 = self.totalSectors if self.totalSectors < 0x10000 and self.fatType != FAT.Type.FAT32 else 0
+		total32 = 0 if total16 else self.totalSectors
+		struct.pack_into ("<3s8sHBHBHHBHHHLL", bs, 0, "\xeb\x58\x90", "GOTEKONF", self.sectorSize, self.sectorsPerCluster,
+			self.reserved, self.numFats, self.rootEntries, total16, 0xF8,
+			self.sectorsPerFat if self.fatType != FAT.Type.FAT32 else 0, 32, 64, 0, total32)
+		if self.fatType == FAT.Type.FAT32:
+			struct.pack_into ("<LHHLHH12xBxBL11s8s", bs, 0x24, self.sectorsPerFat, 0, 0, 2, 1, 6, 0x80, 0x29,
+				self.serial, self.label.ljust (11), "FAT32   ")
+		else:
+			struct.pack_into ("<BxBL11s8s", bs, 0x24, 0x80, 0x29, self.serial, self.label.ljust (11),
+				"FAT12   " if self.fatType == FAT.Type.FAT12 else "FAT16   ")
+		bs[510] = 0x55
+		bs[511] = 0xAA
+		return bs
+
+	def _fat_table (self, plan):
+		eof = {FAT.Type.FAT12: 0xfff, FAT.Type.FAT16: 0xffff, FAT.Type.FAT32: 0x0fffffff}[self.fatType]
+		table = [0] * (self.numClusters + 2)
+		table[0] = (eof & ~0xff) | 0xF8
+		table[1] = eof
+		for node, n, fragments in plan:
+			for a, b in zip (node.clusters, node.clusters[1:]):
+				table[a] = b
+			table[node.clusters[-1]] = eof
+		if self.fatType == FAT.Type.FAT12:
+			out = bytearray (self._fat_bytes (self.numClusters))
+			for i in xrange (0, len (table) - 1, 2):
+				v = table[i] | (table[i + 1] << 12)
+				out[i * 3 / 2:i * 3 / 2 + 3] = struct.pack ("<L", v)[:3]
+			if len (table) % 2:
+				i = len (table) - 1
+				out[i * 3 / 2:i * 3 / 2 + 2] = struct.pack ("<H", table[i])
+			return str (out)
+		else:
+			return struct.pack ("<%d%s" % (len (table), "H" if self.fatType == FAT.Type.FAT16 else "L"), *table)
+
+	def _dir_data (self, node):
+		entries = []
+		if node is self.root:
+			if self.label:
+				entries.append (self._short_entry (self.label.ljust (11), FAT.Attribute.LABEL | FAT.Attribute.ARCHIVE, 0, 0))
+		else:
+			entries.append (self._short_entry (".          ", FAT.Attribute.DIRECTORY, node.clusters[0], 0))
+			parent = self._parent_cluster (node)
+			entries.append (self._short_entry ("..         ", FAT.Attribute.DIRECTORY, parent, 0))
+		for child in node.children:
+			entries.extend (child.lfn)
+			clu = child.clusters[0] if child.clusters else 0
+			if child.isDir:
+				entries.append (self._short_entry (child.shortName, FAT.Attribute.DIRECTORY, clu, 0))
+			else:
+				entries.append (self._short_entry (child.shortName, FAT.Attribute.ARCHIVE, clu, len (child.data)))
+		return "".join (entries)
+
+	def _parent_cluster (self, node):
+		for n in self._walk (self.root):
+			if n.isDir and node in n.children:
+				return 0 if n is self.root else n.clusters[0]
+		raise ImageError ("Orphan node")
+
+	def _write_clusters (self, fp, dataStart, clusters, data):
+		csize = self.clusterSize
+		for i, clu in enumerate (clusters):
+			chunk = data[i * csize:(i + 1) * csize]
+			if chunk:
+				fp.seek (dataStart + (clu - 2) * csize)
+				fp.write (chunk)
+
+	def build (self, fp, extraClusters = 0):
+		"""Writes the image to fp, which must be a writable file object"""
+		self._assign_short_names (self.root)
+		plan = self._plan ()
+		self._layout (self._allocate (plan) + extraClusters)
+		ss = self.sectorSize
+		fatStart = self.reserved * ss
+		rootStart = fatStart + self.numFats * self.sectorsPerFat * ss
+		dataStart = rootStart + self.rootSectors * ss
+		self.dataStart = dataStart
+
+		fp.seek (0)
+		fp.write (self._bootsector ())
+		if self.fatType == FAT.Type.FAT32:
+			# FSInfo
+			fsi = bytearray (ss)
+			struct.pack_into ("<L", fsi, 0, 0x41615252)
+			struct.pack_into ("<LLL", fsi, 484, 0x61417272, 0xFFFFFFFF, 0xFFFFFFFF)
+			fsi[510] = 0x55
+			fsi[511] = 0xAA
+			fp.seek (ss)
+			fp.write (fsi)
+		table = self._fat_table (plan)
+		for i in xrange (self.numFats):
+			fp.seek (fatStart + i * self.sectorsPerFat * ss)
+			fp.write (table)
+
+		for node, n, fragments in plan:
+			if node.isDir:
+				self._write_clusters (fp, dataStart, node.clusters, self._dir_data (node))
+			else:
+				self._write_clusters (fp, dataStart, node.clusters, node.data)
+		if self.fatType != FAT.Type.FAT32:
+			data = self._dir_data (self.root)
+			if len (data) > self.rootSectors * ss:
+				raise ImageError ("Too many entries in root directory")
+			fp.seek (rootStart)
+			fp.write (data)
+
+		# Make sure the file has the full size
+		fp.seek (self.totalSectors * ss - 1)
+		fp.write ("\0")
+		fp.truncate (self.totalSectors * ss)
+
+	def find (self, path):
+		"""Returns the clusters allocated to path by the last build ()"""
+		pos = path.rfind ("/")
+		parent = self._lookup (path[:pos] if pos >= 0 else "")
+		for child in parent.children:
+			if child.name.lower () == path[pos + 1:].lower ():
+				return child.clusters
+		raise ImageError ("No such file: %s" % path)
+
+def make_selector (slots = (), defaultSlot = 1, stats = (0xF5, 0x01, 0, 0)):
+	"""Returns the contents of a selector.adf with the given slots, a list
+	of (shortName, startCluster, fileSize, fileName) tuples"""
+	data = bytearray (SELECTOR_SIZE)
+	struct.pack_into ("<2H4B", data, SELECTOR_STATS_OFFSET, len (slots), defaultSlot, *stats)
+	for n, (shortName, startCluster, fileSize, fileName) in enumerate (slots):
+		struct.pack_into ("<11s2B2I41s", data, SELECTOR_REC_OFFSET + n * SELECTOR_REC_SIZE,
+			shortName, 0, 0, startCluster, fileSize, fileName)
+	return str (data)
+
+def _name (rnd, stem, n, length):
+	"""Returns a unique file name with the given stem and at least length
+	characters before the extension, so that anything over 8 needs LFN
+	entries"""
+	name = "%s %d" % (stem, n)
+	while len (name) < length:
+		name += " " + rnd.choice (("Disk", "Game", "Demo", "Tool", "Intro", "Part", "Side"))
+	return name[:max (length, len ("%s %d" % (stem, n)))].rstrip ()
+
+def generate (fp, fatType = FAT.Type.FAT32, nFiles = 100, depth = 2, perDir = 20, lfnLength = 24,
+		sectorsPerCluster = 8, fileSize = ADF_SIZE, fragmented = 0.0, fragments = 4, extraClusters = 0,
+		seed = 0):
+	"""Writes a synthetic Gotek stick to fp: nFiles disk images spread over
+	directories nested up to depth levels, at most perDir of them per
+	directory, plus a selector.adf mapping all of them to slots. The given
+	fraction of the images is split into the given number of fragments.
+
+	Returns the ImageBuilder, which knows where everything ended up."""
+	rnd = random.Random (seed)
+	b = ImageBuilder (fatType, sectorsPerCluster, seed = seed)
+	b.add_file ("selector.adf", "\0" * SELECTOR_SIZE)
+	paths = []
+	for n in xrange (nFiles):
+		d = n / perDir
+		dirs = []
+		for level in xrange (depth):
+			dirs.append ("Dir %d" % (d % perDir))
+			d /= perDir
+		path = "/".join (dirs[::-1] + [_name (rnd, "Image", n, lfnLength) + ".adf"])
+		# Only the first byte of every cluster is random, enough to tell them apart
+		data = bytearray (fileSize)
+		for off in xrange (0, fileSize, b.clusterSize):
+			data[off] = rnd.randrange (256)
+		b.add_file (path, str (data), fragments if rnd.random () < fragmented else 1)
+		paths.append (path)
+
+	b.build (fp, extraClusters)
+	slots = []
+	for path in paths[:SELECTOR_MAX_SLOTS]:
+		bn = path.rpartition ("/")[2]
+		slots.append ((bn, b.find (path)[0], fileSize, bn))
+	clusters = b.find ("selector.adf")
+	b._write_clusters (fp, b.dataStart, clusters, make_selector (slots))
+	return b
+
+def main ():
+	parser = argparse.ArgumentParser (description = 'Generate a synthetic Gotek USB stick image')
+	parser.add_argument ('--fat', type = int, choices = (12, 16, 32), default = 32, help = "FAT type")
+	parser.add_argument ('--files', type = int, default = 100, help = "Number of disk images")
+	parser.add_argument ('--depth', type = int, default = 2, help = "Directory nesting")
+	parser.add_argument ('--per-dir', type = int, default = 20, dest = "perDir", help = "Disk images per directory")
+	parser.add_argument ('--lfn-length', type = int, default = 24, dest = "lfnLength",
+											 help = "Length of file names, anything over 8 gets LFN entries")
+	parser.add_argument ('--cluster-sectors', type = int, default = 8, dest = "sectorsPerCluster",
+											 help = "Sectors per cluster")
+	parser.add_argument ('--file-size', type = int, default = ADF_SIZE, dest = "fileSize", help = "Size of every image")
+	parser.add_argument ('--fragmented', type = float, default = 0.0,
+											 help = "Fraction of images to fragment (0-1)")
+	parser.add_argument ('--fragments', type = int, default = 4, help = "Fragments per fragmented image")
+	parser.add_argument ('--free', type = int, default = 0, help = "Free clusters to leave at the end")
+	parser.add_argument ('--seed', type = int, default = 0, help = "Random seed")
+	parser.add_argument ('image', type = str, help = 'Image file to write')
+	args = parser.parse_args ()
+
+	fatType = {12: FAT.Type.FAT12, 16: FAT.Type.FAT16, 32: FAT.Type.FAT32}[args.fat]
+	try:
+		with open (args.image, "w+b") as fp:
+			b = generate (fp, fatType, args.files, args.depth, args.perDir, args.lfnLength, args.sectorsPerCluster,
+				args.fileSize, args.fragmented, args.fragments, args.free, args.seed)
+	except ImageError as ex:
+		print >> sys.stderr, "ERROR: %s" % ex
+		sys.exit (10)
+	print "Wrote %s: %d clusters of %d bytes" % (args.image, b.numClusters, b.clusterSize)
+
+if __name__ == "__main__":
+	main ()
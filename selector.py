@@ -8,10 +8,27 @@ import re
 import stat
 import fnmatch
 import argparse
+import bisect
+import hashlib
+import multiprocessing
 
-from collections import namedtuple
+from collections import namedtuple, deque
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 from fat import FAT
+from blockcache import BlockCachedFile
+import iostats
 
 Stats = namedtuple ('Stats', ['nSlots', 'defaultSlot', 'unk1', 'unk2', 'unk3', 'unk4'])
 
@@ -47,50 +64,348 @@ def findInPath (exe):
 	# Not found
 	raise NotFoundInPathException (exe)
 
+def getCacheDir ():
+	"""Directory where we keep our caches, as per the XDG spec"""
+	base = os.environ.get ("XDG_CACHE_HOME") or os.path.join (os.path.expanduser ("~"), ".cache")
+	return os.path.join (base, "gotekonf")
+
+class ScanCache (object):
+	"""Persistent copy of the tree scanned by Fat32Filesystem, keyed by the
+	identity of the volume. It holds the whole file list, reused as is while
+	the fingerprint of the tree matches, and for every directory its hash
+	and its entries, reused as long as the directory hashes the same.
+	"""
+	NAME = "scan"
+	KEY = "tree"
+	VERSION = 4
+
+	def __init__ (self, fat, cacheDir = None):
+		self.fat = fat
+		self.path = os.path.join (cacheDir or getCacheDir (), "%s-%s.pickle" % (self.NAME, fat.volume_id ()))
+
+	def load (self):
+		"""Returns the directory snapshot saved by the last run, or None"""
+		try:
+			with open (self.path, "rb") as fp:
+				data = pickle.load (fp)
+		except (EnvironmentError, EOFError, ValueError, TypeError, AttributeError, pickle.UnpicklingError):
+			return None
+		if not isinstance (data, dict) or data.get ("version") != self.VERSION:
+			return None
+		return data[self.KEY]
+
+	def save (self, dirs):
+		data = {
+			"version": self.VERSION,
+			self.KEY: dirs
+		}
+		# Write to a temporary file first, so that the cache is never seen
+		# half-written
+		tmp = "%s.%d" % (self.path, os.getpid ())
+		try:
+			if not os.path.isdir (os.path.dirname (self.path)):
+				os.makedirs (os.path.dirname (self.path))
+			with open (tmp, "wb") as fp:
+				pickle.dump (data, fp, pickle.HIGHEST_PROTOCOL)
+			os.rename (tmp, self.path)
+		except EnvironmentError as ex:
+			print >> sys.stderr, "WARNING: Cannot save %s cache: %s" % (self.NAME, ex)
+
+class VerifyCache (ScanCache):
+	"""Persistent results of verify (), keyed by (start cluster, chain
+	fingerprint, size) of every image. Sticks cloned from the same master
+	look the same to the FAT, but not what is in their images, so results are
+	kept per device as well as per volume."""
+	NAME = "verify"
+	KEY = "images"
+	VERSION = 2
+
+	def __init__ (self, fat, device, cacheDir = None):
+		ScanCache.__init__ (self, fat, cacheDir)
+		dev = hashlib.sha1 (os.path.realpath (device)).hexdigest ()[:16]
+		self.path = os.path.join (os.path.dirname (self.path), "%s-%s-%s.pickle" % (self.NAME, fat.volume_id (), dev))
+
 class Fat32Filesystem (object):
-	def __init__ (self, device, mountpoint):
+	def __init__ (self, device, mountpoint, useCache = True, writable = False, ioStats = None, blockCache = None):
+		"""The device is memory-mapped, unless blockCache is given: it is
+		then read through a block cache of that many bytes"""
 		self.device = device
 		self.mountpoint = mountpoint
-		self.fat = FAT (open (device, "rb"))
-		self.files = self.get_all_files ()
+		self.ioStats = ioStats if ioStats is not None else iostats.NULL
+		with self.ioStats.phase ("boot sector"):
+			fp = self.ioStats.wrap (open (device, "r+b" if writable else "rb"))
+			if blockCache:
+				fp = BlockCachedFile (fp, maxBytes = blockCache, stats = self.ioStats)
+			# The FAT is only loaded once a chain is needed, e.g. not to set
+			# the default slot
+			self.fat = FAT (fp, cache_fat = FAT.LAZY, use_mmap = not blockCache, stats = self.ioStats)
+
+		# Start from the directories scanned by the last run, if any. The
+		# whole volume is only scanned when the file list is first needed.
+		self.cache = ScanCache (self.fat) if useCache else None
+		self.dirs = {}
+		self.fingerprint = None
+		self.scanned = False
 		#~ for f in self.files:
 			#~ print f["name"], f["cluster"]
 
-	def get_all_files (self, path="", skipDots = True):
-		files = self.fat.read_dir (path)
-		files2 = []
-		for f in files:
-			if f["name"] != "." and f["name"] != "..":
+	# Attributes filled in by refresh ()
+	_SCANNED = ("files", "byCluster", "byPath", "byName", "nParsed")
+
+	def __getattr__ (self, name):
+		if name in Fat32Filesystem._SCANNED:
+			snapshot = self.cache.load () if self.cache else None
+			if snapshot is None or not self._restore (snapshot):
+				self.refresh (pickle.loads (snapshot["dirs"]) if snapshot else None)
+			return self.__dict__[name]
+		raise AttributeError (name)
+
+	def _fingerprint (self, chains, expected = None):
+		"""Cheap hash of the whole tree, given the chains of all the
+		directories: the FAT, and the raw contents of the directories, read
+		in a single pass. Nothing is parsed, and the FAT is not loaded.
+		If the FAT does not match the expected fingerprint, directories are
+		not even read and None is returned."""
+		fatDigest = self.fat.fat_digest ()
+		if expected is not None and fatDigest != expected[0]:
+			return None
+		return (fatDigest, self.fat.dirs_digest (chains))
+
+	def _restore (self, snapshot):
+		"""Takes the whole tree from snapshot, if it still has the same
+		fingerprint. Returns False if it does not."""
+		self.fingerprint = snapshot["fingerprint"]
+		with self.ioStats.phase ("tree scan"):
+			if self._fingerprint (snapshot["chains"], self.fingerprint) != self.fingerprint:
+				return False
+			# Directories are only unpickled if a refresh needs them
+			self.dirs = None
+			self.dirsBlob = snapshot["dirs"]
+			self.nParsed = 0
+			self.files = snapshot["files"]
+			self._buildIndexes ()
+		self.scanned = True
+		self.ioStats.count ("cache_hits", len (snapshot["chains"]))
+		return True
+
+	def _save (self):
+		"""Saves the tree just scanned, unless it has the same fingerprint
+		as the one it was scanned from"""
+		root = self.fat.info["root_start_cluster"]
+		chains = {}
+		for cluster in self.dirs:
+			if cluster or root:
+				chains[cluster] = self.fat.check_cluster_chain (cluster or root)[0]
+			else:
+				chains[cluster] = []
+		fingerprint = self._fingerprint (chains)
+		if fingerprint != self.fingerprint:
+			self.cache.save ({
+				"fingerprint": fingerprint,
+				"chains": chains,
+				# Only needed when something changed, see _restore ()
+				"dirs": pickle.dumps (self.dirs, pickle.HIGHEST_PROTOCOL),
+				"files": self.files
+			})
+		self.fingerprint = fingerprint
+
+	def refresh (self, previous = None):
+		"""(Re)builds the file list. All directories are hashed, but only
+		those that changed since the previous snapshot (by default the one
+		taken by the last scan) are parsed again, the others are reused from
+		there. Note that unchanged directories must still be descended into,
+		since changes to a subdirectory do not show up in its parent. When
+		nothing changed at all, the file list is not even rebuilt, see
+		_restore ().
+
+		Returns the number of directories that were parsed."""
+		if previous is None:
+			previous = self.dirs if self.dirs is not None else pickle.loads (self.dirsBlob)
+		if self.scanned:
+			# The device might have changed since we loaded it
+			self.fat.invalidate_fat ()
+			self.fat.invalidate_dirs ()
+		with self.ioStats.phase ("tree scan"):
+			self.dirs = {}
+			self.nParsed = 0
+			self.files = self._scanDir (0, "", previous)
+			self._buildIndexes ()
+			if self.cache:
+				self._save ()
+		self.scanned = True
+		self.ioStats.count ("cache_hits", len (self.dirs) - self.nParsed)
+		self.ioStats.count ("cache_misses", self.nParsed)
+		return self.nParsed
+
+	def _scanDir (self, cluster, path, previous):
+		digest = self.fat.dir_digest (cluster)
+		old = previous.get (cluster)
+		if old is not None and old[0] == digest:
+			entries = old[1]
+		else:
+			entries = self.fat.read_dir_cluster (cluster)
+			self.nParsed += 1
+		self.dirs[cluster] = (digest, entries)
+
+		files = []
+		for e in entries:
+			if e.name != "." and e.name != "..":
+				# Snapshot entries are shared, so work on copies
+				f = FAT.DirEntry (*e.fields ())
 				if len (path):
-					f["name"] = path + "/" + f["name"]
-				if f["attributes"] & FAT.Attribute.DIRECTORY:
-					#~ print "Recursing into '%s' - '%s'" % (f["name"], path)
-					files2.extend (self.get_all_files (f["name"]))
-				files2.append (f)
-			elif not skipDots:
-				files2.append (f)
-		return files2
+					f.name = path + "/" + f.name
+				if f.attributes & FAT.Attribute.DIRECTORY and f.cluster not in self.dirs:
+					files.extend (self._scanDir (f.cluster, f.name, previous))
+				files.append (f)
+		return files
 
-	def getFileAtCluster (self, clu):
-		fn = filter (lambda f: f["cluster"] == clu, self.files)
+	@staticmethod
+	def normalizePath (path):
+		"""FAT is case-insensitive, and so are our lookups"""
+		return "/".join (filter (len, path.split ("/"))).lower ()
+
+	def _buildIndexes (self):
+		"""Index files by starting cluster, path and basename, all lookups
+		then take constant time. Every key maps to the list of all matching
+		files, so that ambiguous lookups can be told apart.
+
+		Basenames are indexed as they would appear in the record of a slot.
+		Since records may hold truncated names, every file is also indexed by
+		its basename cut to the length of the fileName and shortName fields.
+		Directories cannot be in a slot and are left out."""
+		fnLen = SlotTable.FILE_NAME_LEN
+		snLen = SlotTable.SHORT_NAME_LEN
+		byCluster = self.byCluster = {}
+		byPath = self.byPath = {}
+		byName = self.byName = {}
+		for f in self.files:
+			byCluster.setdefault (f.cluster, []).append (f)
+			# Paths built by _scanDir () are already normalized, but for case
+			path = f.name.lower ()
+			byPath.setdefault (path, []).append (f)
+			if not f.attributes & FAT.Attribute.DIRECTORY:
+				bn = encodeName (f.name.rpartition ("/")[2]).lower ()
+				byName.setdefault (bn, []).append (f)
+				for key in (bn[:fnLen], bn[:snLen]):
+					if key != bn:
+						byName.setdefault (key, []).append (f)
+
+	def getEntryAtCluster (self, clu):
+		fn = self.byCluster.get (clu, [])
 		if len (fn) == 1:
-			ret = fn[0]["name"]
+			ret = fn[0]
 		else:
 			ret = None
 		return ret
 
+	def getFileAtCluster (self, clu):
+		f = self.getEntryAtCluster (clu)
+		return f["name"] if f is not None else None
+
 	def getStartingCluster (self, path):
 		"""path must be relative to device root"""
-		fn = filter (lambda f: f["name"] == path, self.files)
+		fn = self.byPath.get (self.normalizePath (path), [])
 		if len (fn) == 1:
 			ret = fn[0]["cluster"]
 		else:
 			ret = None
 		return ret
 
+	def getFilesByName (self, name):
+		"""Returns all files with the given basename (or its truncation to a
+		slot record field), anywhere on the volume"""
+		return self.byName.get (encodeName (name).lower (), [])
+
 class SelectorException (BaseException):
 	pass
 
+class SlotTable (object):
+	"""All the slot records of selector.adf, kept packed in a single buffer
+	and only decoded on access"""
+
+	# The record is followed by padding up to Selector.REC_SIZE
+	RECORD = struct.Struct ("< 11s 2B 2I 41s")
+	SHORT_NAME_LEN = 11
+	FILE_NAME_LEN = 41
+
+	def __init__ (self, buf, offset = 0):
+		size = Selector.REC_SIZE * Selector.MAX_SLOTS
+		if len (buf) < offset + size:
+			raise SelectorException ("Read from selector.adf failed")
+		self.buf = bytearray (buf[offset:offset + size])
+		# What is currently on disk
+		self.orig = str (self.buf)
+		self.used = self._findUsed ()
+
+	def _findUsed (self):
+		"""Returns the numbers of the slots in use, checking that all the
+		bytes we expect to be zero actually are"""
+		pad = SlotTable.RECORD.size
+		if numpy is not None:
+			recs = numpy.frombuffer (self.buf, dtype = numpy.uint8).reshape (Selector.MAX_SLOTS, Selector.REC_SIZE)
+			used = recs[:, 0] != 0
+			bad = used & ((recs[:, 11:13] != 0).any (1) | (recs[:, pad:] != 0).any (1))
+			assert not bad.any (), "Unexpected data in slots %s" % (numpy.flatnonzero (bad) + 1).tolist ()
+			return (numpy.flatnonzero (used) + 1).tolist ()
+		else:
+			zeros = bytearray (Selector.REC_SIZE - pad)
+			used = []
+			for i in xrange (0, Selector.MAX_SLOTS):
+				offset = i * Selector.REC_SIZE
+				if self.buf[offset] != 0:
+					# Some sanity checks, for what we understood the format
+					assert self.buf[offset + 11] == 0 and self.buf[offset + 12] == 0
+					assert self.buf[offset + pad:offset + Selector.REC_SIZE] == zeros
+					used.append (i + 1)
+			return used
+
+	def getSlot (self, n):
+		"""Decodes slot n, diskFileName is left for the caller to fill"""
+		data = SlotTable.RECORD.unpack_from (self.buf, (n - 1) * Selector.REC_SIZE)
+		shortName = data[0].rstrip ('\0')
+		startCluster = data[3]
+		fileSize = data[4]
+		fileName = data [5].rstrip ('\0')
+		return Slot (n, False, shortName, startCluster, fileSize, fileName, None)
+
+	def setSlot (self, slot):
+		"""Encodes slot into its record, or clears the record if the slot is
+		to be cleared. Nothing is written to disk until commit."""
+		offset = (slot.num - 1) * Selector.REC_SIZE
+		self.buf[offset:offset + Selector.REC_SIZE] = bytearray (Selector.REC_SIZE)
+		if slot.cleared:
+			if slot.num in self.used:
+				self.used.remove (slot.num)
+		else:
+			# struct.pack() will take care of padding and or shortening long/short strings
+			SlotTable.RECORD.pack_into (self.buf, offset, slot.shortName, 0, 0, slot.startCluster, slot.fileSize, slot.fileName)
+			if slot.num not in self.used:
+				bisect.insort (self.used, slot.num)
+
+	def dirtyRuns (self):
+		"""Returns the records that differ from what is on disk, as runs of
+		adjacent records: a list of (first slot, number of slots)"""
+		runs = []
+		size = Selector.REC_SIZE
+		for i in xrange (0, Selector.MAX_SLOTS):
+			offset = i * size
+			if self.buf[offset:offset + size] != self.orig[offset:offset + size]:
+				if runs and runs[-1][0] + runs[-1][1] == i + 1:
+					runs[-1][1] += 1
+				else:
+					runs.append ([i + 1, 1])
+		return [tuple (r) for r in runs]
+
+	def markClean (self):
+		self.orig = str (self.buf)
+
+	def __len__ (self):
+		return len (self.used)
+
+	def __iter__ (self):
+		for n in self.used:
+			yield self.getSlot (n)
+
 class Selector (object):
 	STATS_OFFSET = 0x29416
 	STATS_SIZE = 8
@@ -98,21 +413,39 @@ class Selector (object):
 	REC_SIZE = 128
 	MAX_SLOTS = 999
 
-	_SLOT_STRUCT = "< 11s 2B 2I 41s 66B"
+	_STATS_STRUCT = "< 2H 4B"
 
-	def __init__ (self, _dev, _mntp):
+	def __init__ (self, _dev, _mntp, useCache = True, ioStats = None, blockCache = None, writable = False):
+		"""If _mntp is None, _dev must not be mounted: selector.adf is then
+		found in the FAT tree and accessed through its cluster chain, so
+		everything goes through the same file. writable must be True for
+		commit () to work in this case."""
 		self.dev = _dev
 		self.mountpoint = _mntp
-		self.fs = Fat32Filesystem (_dev, _mntp)
+		self.ioStats = ioStats if ioStats is not None else iostats.NULL
+		self.fs = Fat32Filesystem (_dev, _mntp, useCache, writable = writable and _mntp is None,
+			ioStats = self.ioStats, blockCache = blockCache)
+
+		if _mntp is not None:
+			self.adf = os.path.join (_mntp, "selector.adf")
+			if not os.path.isfile (self.adf):
+				raise SelectorException ("selector.adf not found")
+		else:
+			self.adf = None
+			try:
+				self.fs.fat.open ("selector.adf").close ()
+			except FAT.FileNotFoundError:
+				raise SelectorException ("selector.adf not found")
 
-		self.adf = os.path.join (_mntp, "selector.adf")
-		if not os.path.isfile (self.adf):
-			raise SelectorException ("selector.adf not found")
+	def _openAdf (self, write = False):
+		if self.adf is not None:
+			return self.ioStats.wrap (open (self.adf, "rb+" if write else "rb"))
+		else:
+			# Goes through the FAT, which counts what it does itself
+			return self.fs.fat.open ("selector.adf", writable = write)
 
-	def _getStats (self, fp):
-		fp.seek (Selector.STATS_OFFSET)
-		buf = fp.read (Selector.STATS_SIZE)
-		data = struct.unpack ("2H 4B", buf)
+	def _getStats (self, buf):
+		data = struct.unpack_from (Selector._STATS_STRUCT, buf)
 		nSlots = data[0]
 		defaultSlot = data[1]
 		unk1 = data[2]	# Went E5, F5...
@@ -124,64 +457,53 @@ class Selector (object):
 	def _getSlotOffset (self, n):
 		return Selector.REC_OFFSET + (n - 1) * Selector.REC_SIZE
 
-	# Read records
-	def _getSlots (self, fp):
+	# Decode records
+	def _getSlots (self, table):
 		slots = {}
-
-		fp.seek (Selector.REC_OFFSET)
-		for i in range (1, Selector.MAX_SLOTS + 1):
-			#~ print fp.tell ()
-			assert self._getSlotOffset (i) == fp.tell ()
-			buf = fp.read (Selector.REC_SIZE)
-			if not buf:
-				raise SelectorException ("Read from selector.adf failed")
-
-			if buf[0] != '\0':
-				data = struct.unpack ("< 11s 2B 2I 41s 66B", buf)
-				shortName = data[0].rstrip ('\0')
-				unk1 = data[1]
-				unk2 = data[2]
-				startCluster = data[3]
-				fileSize = data[4]
-				fileName = data [5].rstrip ('\0')
-				zeros = data [6:]
-
-				# Some sanity checks, for what we understood the format
-				assert unk1 == 0
-				assert unk2 == 0
-				assert all ([x == 0 for x in zeros])
-
-				# Try to come up with actual file corresponding to cluster
-				# Will be None if not found
-				fn = self.fs.getFileAtCluster (startCluster)
-
-				s = Slot (i, False, shortName, startCluster, fileSize, fileName, fn)
-				slots[i] = s
-
+		for s in table:
+			# Try to come up with actual file corresponding to cluster
+			# Will be None if not found
+			s.diskFileName = self.fs.getFileAtCluster (s.startCluster)
+			slots[s.num] = s
 		return slots
 
-	def scan (self):
-		with open (self.adf, "rb") as fp:
-			self.stats = self._getStats (fp)
+	def scan (self, resolve = True):
+		"""Reads the stats and the slots. Unless resolve is False, the file
+		every slot points to is also looked up, which needs the whole volume
+		to be scanned."""
+		# Stats and records are close enough to fetch them with a single read
+		with self.ioStats.phase ("slot parse"):
+			with self._openAdf () as fp:
+				fp.seek (Selector.STATS_OFFSET)
+				buf = fp.read (self._getSlotOffset (Selector.MAX_SLOTS + 1) - Selector.STATS_OFFSET)
+			if len (buf) < Selector.STATS_SIZE:
+				raise SelectorException ("Read from selector.adf failed")
+			self.stats = self._getStats (buf)
+			self._diskStats = self.stats
 			self.defaultSlot = self.stats.defaultSlot
-			self.slots = self._getSlots (fp)
+			self.table = SlotTable (buf, Selector.REC_OFFSET - Selector.STATS_OFFSET)
+		if resolve:
+			if len (self.table):
+				# Scan the tree in its own phase, not within this one
+				self.fs.files
+			with self.ioStats.phase ("slot resolution"):
+				self.slots = self._getSlots (self.table)
+		else:
+			self.slots = dict ((s.num, s) for s in self.table)
 		assert self.stats.nSlots == len (self.slots)
 
+	# Note that all changes are only written to disk by commit ()
+
 	def setDefaultSlot (self, slotNo):
 		if slotNo in self.slots:
-			with open (self.adf, "rb+") as fp:
-				fp.seek (Selector.STATS_OFFSET + 2)
-				s = struct.pack ("< H", slotNo)
-				fp.write (s)
+			self.stats = self.stats._replace (defaultSlot = slotNo)
+			self.defaultSlot = slotNo
 		else:
 			raise SelectorException ("Cannot set an empty slot as default")
 
 	def setNumSlots (self, nSlots):
 		if nSlots <= Selector.MAX_SLOTS:
-			with open (self.adf, "rb+") as fp:
-				fp.seek (Selector.STATS_OFFSET)
-				s = struct.pack ("< H", nSlots)
-				fp.write (s)
+			self.stats = self.stats._replace (nSlots = nSlots)
 		else:
 			raise SelectorException ("Invalid number of slots")
 
@@ -197,99 +519,131 @@ class Selector (object):
 
 	# Call this with a DICT (slot# -> slot)
 	def updateSlots (self, slots):
-		with open (self.adf, "rb+") as fp:
-			fp.seek (Selector.REC_OFFSET)
-			for i in range (1, Selector.MAX_SLOTS + 1):
-				assert self._getSlotOffset (i) == fp.tell ()
-				if i in slots:
-					slot = slots[i]
-					if slot.cleared:
-						buf = struct.pack ("< 128B", *([0] * Selector.REC_SIZE))
-					else:
-						# struct.pack() will take care of padding and or shortening long/short strings
-						buf = struct.pack (Selector._SLOT_STRUCT, slot.shortName, 0, 0, slot.startCluster, slot.fileSize, slot.fileName, *([0] * 66))
-					fp.write (buf)
-
-def findFile (fn, root):
-	ret = []
-	for f in os.listdir (root):
-		fullf = os.path.join (root, f)
-		if os.path.isdir (fullf):
-			ret.extend (findFile (fn, fullf))
-		elif os.path.isfile (fullf) and f == fn:
-			#~ print "Found: %s" % fullf
-			ret.append (fullf)
-	return sorted (ret)
-
-def checkSlots (mntp, slots, fix = True):
+		for slot in slots.itervalues ():
+			self.table.setSlot (slot)
+
+	def commit (self):
+		"""Writes all pending changes to selector.adf in one go: the stats if
+		they changed, and only the slot records that changed, with adjacent
+		ones merged into a single write. Returns the number of writes."""
+		writes = []
+		if self.stats != self._diskStats:
+			writes.append ((Selector.STATS_OFFSET, struct.pack (Selector._STATS_STRUCT, *self.stats)))
+		for first, count in self.table.dirtyRuns ():
+			offset = (first - 1) * Selector.REC_SIZE
+			writes.append ((self._getSlotOffset (first), self.table.buf[offset:offset + count * Selector.REC_SIZE]))
+		if writes:
+			with self.ioStats.phase ("commit"):
+				with self._openAdf (write = True) as fp:
+					for offset, data in writes:
+						fp.seek (offset)
+						fp.write (data)
+					fp.flush ()
+		self._diskStats = self.stats
+		self.table.markClean ()
+		return len (writes)
+
+def checkSlots (sel, fix = False):
+	"""Reports slots pointing to missing files or with the wrong size. If fix
+	is set, slots are updated where the file can be found unambiguously and
+	cleared where it cannot be found at all, and the changes are written to
+	selector.adf. Returns the number of problems found."""
 	nProb = 0
-	for n, slot in s.slots.iteritems ():
+	fixed = {}
+	for n, slot in sel.slots.iteritems ():
 		if slot.diskFileName is None:
 			# No file found at cluster, see if filename still exists. Note that
-			# this will most likely fail, as slot.filename might not contain a
-			# full filename. Also the path is lost.
-			candidates = findFile (slot.fileName, mntp)
-			candidates = map (lambda f: f[len (mntp) + 1:], candidates)
+			# slot.filename might not contain a full filename, and the path is
+			# lost, so look it up by basename in the whole tree and use the size
+			# to tell candidates apart.
+			candidates = sel.fs.getFilesByName (slot.fileName) or sel.fs.getFilesByName (slot.shortName)
+			sameSize = filter (lambda f: f["size"] == slot.fileSize, candidates)
+			if sameSize:
+				candidates = sameSize
 			print "File for slot %d is missing: %s (c=%u)" % (n, slot.fileName, slot.startCluster)
 
-			# FIXME
-			if True or len (candidates) == 0:
-				print "No candidates found, clearing slot"
+			if len (candidates) == 0:
+				print "No candidates found%s" % (", clearing slot" if fix else "")
 				if fix:
 					slot.cleared = True
+					fixed[n] = slot
 			elif len (candidates) == 1:
-				print "Found %s, updating record"
-				# FIXME
+				f = candidates[0]
+				print "Found %s%s" % (encodeName (f["name"]), ", updating record" if fix else "")
+				if fix:
+					slot.diskFileName = f["name"]
+					slot.startCluster = f["cluster"]
+					slot.fileSize = f["size"]
+					fixed[n] = slot
 			else:
 				print "Found several candidates:"
-				for n, c in enumerate (candidates, start = 1):
-					print "%2d. %s" % (n, c)
-					# FIXME
+				for i, c in enumerate (sorted (candidates, key = lambda f: f["name"]), start = 1):
+					print "%2d. %s" % (i, encodeName (c["name"]))
 			#~ print slot
 			nProb += 1
 		else:
-			fullpath = os.path.join (mntp, slot.diskFileName)
-			assert os.path.isfile (fullpath)
-			st = os.stat (fullpath)
-			#~ print st
-			#~ print slot.startCluster
-			sz = os.path.getsize (fullpath)
-			if sz != slot.fileSize:
+			f = sel.fs.getEntryAtCluster (slot.startCluster)
+			assert f is not None
+			if f["size"] != slot.fileSize:
 				print "Slot %d has wrong filesize" % n
 				if fix:
-					slot.fileSize = sz
+					slot.fileSize = f["size"]
+					fixed[n] = slot
 				nProb += 1
+
+	if fixed:
+		sel.updateSlots (fixed)
+		for n, slot in fixed.iteritems ():
+			if slot.cleared:
+				del sel.slots[n]
+		sel.setNumSlots (len (sel.slots))
+		sel.commit ()
+		print "Updated %d slots" % len (fixed)
 	return nProb
 
-def findFiles (pattern, root):
-	ret = []
-	recurse = []
-	for f in os.listdir (root):
-		fullf = os.path.join (root, f)
-		if os.path.isdir (fullf):
-			recurse.append (fullf)
-		elif os.path.isfile (fullf) and fnmatch.fnmatch (f.lower (), pattern):
-			#~ print "Found: %s" % fullf
-			ret.append (fullf)
-	ret = sorted (ret)
-	for d in sorted (recurse):
-		ret.extend (findFiles (pattern, d))
-	return ret
+def encodeName (name):
+	"""Long file names are unicode, records and the terminal want bytes"""
+	return name.encode ("utf8") if isinstance (name, unicode) else name
+
+def findImages (fs, pattern):
+	"""Returns the entries of all the files matching pattern, taken from the
+	already-scanned FAT tree. Files are sorted in each directory and come
+	before subdirectories, which are then descended in order."""
+	tree = {}
+	for f in fs.files:
+		parent = f["name"].rpartition ("/")[0]
+		files, dirs = tree.setdefault (parent, ([], []))
+		if f["attributes"] & FAT.Attribute.DIRECTORY:
+			dirs.append (f)
+		elif fnmatch.fnmatch (f["name"].rpartition ("/")[2].lower (), pattern):
+			files.append (f)
+
+	def walk (path):
+		files, dirs = tree.get (path, ([], []))
+		# 8.3 names are bytes and LFNs unicode, which cannot be compared
+		ret = sorted (files, key = lambda f: encodeName (f["name"]))
+		for d in sorted (dirs, key = lambda f: encodeName (f["name"])):
+			ret.extend (walk (d["name"]))
+		return ret
+
+	return walk ("")
+
+def findDiskImages (fs):
+	"""Returns the entries of all the ADF files, in the order of findImages (),
+	leaving out selector.adf"""
+	adfs = findImages (fs, "*.adf")
+	return filter (lambda f: f["name"].rpartition ("/")[2].lower () != "selector.adf", adfs)
 
 def remap (sel, verbose = False):
-	adfs = findFiles ("*.adf", sel.mountpoint)
-	adfs = filter (lambda f: os.path.basename (f).lower () != "selector.adf", adfs)
+	adfs = findDiskImages (sel.fs)
 	print "Found %d ADF files:" % len (adfs)
 
 	slots = {}
 	for n, adf in enumerate (adfs, start = 1):
-		relpath = os.path.relpath (adf, sel.mountpoint)
+		relpath = encodeName (adf["name"])
 		print "%2d. %s" % (n, relpath),
-		bn = os.path.basename (adf)
-		sz = os.path.getsize (adf)
-		slot = Slot (n, False, bn, 0x00, sz, bn, relpath)
-		mapped = sel.mapSlot (slot)
-		assert mapped, "Cannot find cluster for file '%s'" % adf
+		bn = relpath.rpartition ("/")[2]
+		slot = Slot (n, False, bn, adf["cluster"], adf["size"], bn, relpath)
 		if verbose:
 			print "(c=%u)" % slot.startCluster
 		else:
@@ -302,8 +656,283 @@ def remap (sel, verbose = False):
 
 	# Commit
 	assert len (slots) == Selector.MAX_SLOTS, len (slots)
-	s.updateSlots (slots)
-	s.setNumSlots (len (adfs))
+	sel.updateSlots (slots)
+	sel.setNumSlots (len (adfs))
+	sel.commit ()
+
+# ADFs are raw dumps of 80 to 84 cylinders, with two tracks each made of 11
+# (DD) or 22 (HD) sectors of 512 bytes
+ADF_TRACK_DD = 11 * 512
+ADF_TRACK_HD = 22 * 512
+ADF_CYLINDERS = (80, 84)
+
+# SHA-1 of blank images, by size
+_blankHashes = {}
+
+def checkAdf (data):
+	"""Hashes a disk image and checks that it looks like a sane ADF.
+	Returns the SHA-1 and a list of problems, empty if none."""
+	sha1 = hashlib.sha1 (data).hexdigest ()
+	size = len (data)
+	problems = []
+	if size <= ADF_CYLINDERS[1] * 2 * ADF_TRACK_DD:
+		track = ADF_TRACK_DD
+	else:
+		track = ADF_TRACK_HD
+	if size % track:
+		problems.append ("size %u is not a whole number of tracks" % size)
+	elif not ADF_CYLINDERS[0] <= size / track / 2 <= ADF_CYLINDERS[1]:
+		problems.append ("size %u is not 80 to 84 cylinders" % size)
+	if size not in _blankHashes:
+		_blankHashes[size] = hashlib.sha1 ("\0" * size).hexdigest ()
+	if sha1 == _blankHashes[size]:
+		problems.append ("image is blank")
+	elif str (data[:3]) == "DOS" and size < 1024:
+		problems.append ("bootblock is truncated")
+	elif str (data[:3]) == "DOS" and str (data[12:1024]).strip ("\0"):
+		# Only disks with boot code need a valid checksum, data disks are left
+		# without one. The bootblock checksum is the sum of its longwords with
+		# carry wraparound, complemented.
+		csum = 0
+		for l in struct.unpack (">256L", str (data[:1024])):
+			csum += l
+			if csum > 0xffffffff:
+				csum -= 0xffffffff
+		if csum != 0xffffffff:
+			problems.append ("bootblock checksum is wrong")
+	return sha1, problems
+
+def verify (sel, verbose = False, useCache = True, threads = None):
+	"""Reads the image every slot points to, following its FAT chain, then
+	hashes it and checks it is a sane ADF (see checkAdf ()). Reading is done
+	in a single pass over the device (see FAT.read_chains ()), while images
+	are checked by a pool of threads, hashlib releasing the GIL.
+
+	Results are cached per device by (start cluster, chain fingerprint,
+	size), images that did not move are not read again. Note that this means images
+	rewritten in place are not noticed, use useCache = False for that.
+
+	Returns the number of bad images."""
+	fat = sel.fs.fat
+	csize = fat.cluster_size ()
+	cache = VerifyCache (fat, sel.dev) if useCache else None
+	cached = (cache.load () if cache else None) or {}
+	results = {}
+	keys = {}
+	todo = []
+	for slot in sel.slots.itervalues ():
+		chain, problem = fat.check_cluster_chain (slot.startCluster)
+		if problem is None and len (chain) * csize < slot.fileSize:
+			problem = "chain is %u bytes short" % (slot.fileSize - len (chain) * csize)
+		if problem is not None:
+			results[slot.num] = (None, [problem])
+			continue
+		fingerprint = hashlib.sha1 (repr (FAT.chain_to_extents (chain))).hexdigest ()
+		key = keys[slot.num] = (slot.startCluster, fingerprint, slot.fileSize)
+		if key in cached:
+			results[slot.num] = cached[key]
+		else:
+			todo.append ((slot.num, chain, slot.fileSize))
+	nCached = len (keys) - len (todo)
+
+	def collect (num, res):
+		# An image that cannot be checked is a problem with that image only
+		try:
+			results[num] = res.get ()
+		except Exception as ex:
+			results[num] = (None, ["cannot be checked: %s" % ex])
+
+	threads = threads or multiprocessing.cpu_count ()
+	pool = ThreadPool (threads)
+	try:
+		# Keep a bounded number of images in memory
+		pending = deque ()
+		for num, data in fat.read_chains (todo):
+			pending.append ((num, pool.apply_async (checkAdf, (data, ))))
+			while len (pending) > 2 * threads:
+				collect (*pending.popleft ())
+		for num, res in pending:
+			collect (num, res)
+	finally:
+		pool.close ()
+		pool.join ()
+
+	nBad = 0
+	for num in sorted (results):
+		sha1, problems = results[num]
+		name = encodeName (sel.slots[num].diskFileName or sel.slots[num].fileName)
+		if problems:
+			print "%2d. %s: %s" % (num, name, ", ".join (problems))
+			nBad += 1
+		elif verbose:
+			print "%2d. %s: OK (%s)" % (num, name, sha1)
+	print "Verified %d images (%d from cache), %d bad" % (len (results), nCached, nBad)
+
+	if cache:
+		cache.save (dict ((keys[num], results[num]) for num in keys if results[num][0] is not None))
+	return nBad
+
+class LazyFile (object):
+	"""A file that is only opened when first read, so that many of them can
+	be handed out at once"""
+	def __init__ (self, path):
+		self.path = path
+		self.fp = None
+
+	def read (self, size = -1):
+		if self.fp is None:
+			self.fp = open (self.path, "rb")
+		return self.fp.read (size)
+
+	def close (self):
+		if self.fp is not None:
+			self.fp.close ()
+			self.fp = None
+
+def importImages (sel, sources, target = "", verbose = False):
+	"""Writes disk images straight to the volume of sel, which must have been
+	opened for writing on a device or image that is not mounted, into the
+	target directory, then assigns them to the slots following the last one
+	in use. sources are disk images or directories, of which all disk images
+	are taken. Everything is written in a single pass, see FAT.add_files ().
+	Returns the number of images imported."""
+	paths = []
+	for src in sources:
+		if os.path.isdir (src):
+			paths.extend (sorted (os.path.join (src, f) for f in os.listdir (src) if f.lower ().endswith (".adf")))
+		else:
+			paths.append (src)
+	files = [(os.path.basename (p), os.path.getsize (p), LazyFile (p)) for p in paths]
+	entries = sel.fs.fat.add_files (target, files)
+	print "Imported %d images" % len (entries)
+
+	target = "/".join (filter (len, target.split ("/")))
+	num = max (sel.slots) + 1 if sel.slots else 1
+	for entry in entries:
+		relpath = encodeName ((target + "/" if target else "") + entry.name)
+		if num > Selector.MAX_SLOTS:
+			print "No free slot for %s" % relpath
+			continue
+		bn = relpath.rpartition ("/")[2]
+		slot = Slot (num, False, bn, entry.cluster, entry.size, bn, relpath)
+		sel.table.setSlot (slot)
+		sel.slots[num] = slot
+		if verbose:
+			print "%2d. %s (c=%u)" % (num, relpath, entry.cluster)
+		num += 1
+	sel.setNumSlots (len (sel.slots))
+	sel.commit ()
+	sel.fs.fat.flush ()
+	return len (entries)
+
+def reportFragmentation (sel, verbose = False):
+	"""Prints how fragmented every disk image is, plus a summary for the
+	whole volume. Images whose chain shares clusters with another one are
+	listed as cross-linked, those whose chain is otherwise broken (e.g. it
+	loops) as damaged, and both are left out of the averages, their figures
+	would make no sense. Returns the number of fragmented images."""
+	fat = sel.fs.fat
+	frag = fat.get_fragmentation ()
+	crossLinked = fat.get_cross_linked ()
+	adfs = findDiskImages (sel.fs)
+	print "%-7s %-9s %-11s %s" % ("Extents", "Max gap", "Contiguous", "Image")
+	nFrag = nCross = nDamaged = nExtents = nClusters = nContiguous = 0
+	for adf in adfs:
+		info = frag.get (adf["cluster"])
+		# An image starting in the middle of another chain is no chain head
+		if info is None or crossLinked:
+			chain, problem = fat.check_cluster_chain (adf["cluster"])
+			if problem is not None:
+				print "%7s %9s %11s %s (%s)" % ("-", "-", "damaged", encodeName (adf["name"]), problem)
+				nDamaged += 1
+				continue
+			elif info is None or crossLinked.intersection (chain):
+				print "%7s %9s %11s %s" % ("-", "-", "cross-link", encodeName (adf["name"]))
+				nCross += 1
+				continue
+		if info["extents"] > 1 or verbose:
+			print "%7u %9u %10.1f%% %s" % (info["extents"], info["largest_gap"], info["contiguous"], encodeName (adf["name"]))
+		if info["extents"] > 1:
+			nFrag += 1
+		nExtents += info["extents"]
+		nClusters += info["clusters"]
+		nContiguous += info["clusters"] - info["extents"]
+	print
+	print "Images: %d, fragmented: %d, cross-linked: %d, damaged: %d" % (len (adfs), nFrag, nCross, nDamaged)
+	nSound = len (adfs) - nCross - nDamaged
+	if nSound:
+		print "Average extents per image: %.2f" % (float (nExtents) / nSound)
+		links = nClusters - nSound
+		print "Contiguous links: %.1f%%" % (100.0 * nContiguous / links if links else 100.0)
+	return nFrag
+
+def updateSlotClusters (fs, moved):
+	"""Points the slots that start at a cluster in moved (a dict mapping old
+	starting clusters to new ones) to the new cluster. Works directly on the
+	records of selector.adf through the FAT, so the device need not be
+	mounted. Returns the number of slots updated."""
+	n = 0
+	with fs.fat.open ("selector.adf", writable = True) as fp:
+		fp.seek (Selector.REC_OFFSET)
+		table = SlotTable (fp.read (Selector.REC_SIZE * Selector.MAX_SLOTS))
+		for slot in table:
+			if slot.startCluster in moved:
+				slot.startCluster = moved[slot.startCluster]
+				table.setSlot (slot)
+				n += 1
+		for first, count in table.dirtyRuns ():
+			offset = (first - 1) * Selector.REC_SIZE
+			fp.seek (Selector.REC_OFFSET + offset)
+			fp.write (table.buf[offset:offset + count * Selector.REC_SIZE])
+	return n
+
+def defrag (fs, verbose = False):
+	"""Moves every fragmented disk image to a contiguous run of free
+	clusters, then updates the slots pointing to them. fs must have been
+	opened for writing, on a device that is not mounted. Returns the number
+	of images moved."""
+	fat = fs.fat
+	frag = fat.get_fragmentation ()
+	adfs = filter (lambda f: f["cluster"] in frag and frag[f["cluster"]]["extents"] > 1, findImages (fs, "*.adf"))
+	print "Found %d fragmented images" % len (adfs)
+
+	# Moving an image frees its old clusters, so images whose chain is
+	# damaged, or shares clusters with another one, must be left alone
+	crossLinked = fat.get_cross_linked ()
+	moved = {}
+	for adf in adfs:
+		chain, problem = fat.check_cluster_chain (adf["cluster"])
+		if problem is None and crossLinked.intersection (chain):
+			problem = "chain is cross-linked"
+		if problem is not None:
+			print "%s: %s, skipping" % (encodeName (adf["name"]), problem)
+			continue
+		size = frag[adf["cluster"]]["clusters"]
+		# Best fit, to keep large free runs for large images. Free space must
+		# be looked up again every time, as moving an image frees its clusters
+		fits = filter (lambda r: r[1] >= size, fat.get_free_extents ())
+		if not fits:
+			print "No contiguous free space for %s, skipping" % encodeName (adf["name"])
+			continue
+		start = min (fits, key = lambda r: r[1])[0]
+		old = adf["cluster"]
+		try:
+			fat.relocate_file (adf, start, size)
+		except ValueError as ex:
+			print "%s, skipping" % ex
+			continue
+		moved[old] = start
+		if verbose:
+			print "%s: c=%u -> c=%u" % (encodeName (adf["name"]), old, start)
+	fs._buildIndexes ()
+
+	if moved:
+		try:
+			print "Updated %d slots" % updateSlotClusters (fs, moved)
+		except FAT.FileNotFoundError:
+			print "selector.adf not found, no slots to update"
+	fat.flush ()
+	return len (moved)
 
 
 # Thanks tzot ;)
@@ -326,71 +955,226 @@ def get_mounted_device(pathname):
 		pass
 	return None # explicit
 
-parser = argparse.ArgumentParser (description = 'Manage disk images for Amiga Gotek drives')
-parser.add_argument ('--list', "-l", action = 'store_true', default = False, help = "List disk images")
-parser.add_argument ('--check', "-c", action = 'store_true', default = False, help = "Check disk images")
-parser.add_argument ('--remap', "-r", action = 'store_true', default = False, help = "Remap all disk images to slots")
-parser.add_argument ('--set-default', "-d", metavar = "IMAGE_NO", default = None, dest = "defaultImage",
-										 help = "Number of image to set as default")
-parser.add_argument ('--verbose', "-v", action = 'store_true', default = False, help = "Be verbose")
-parser.add_argument ('path', default = None, type = str, help = 'USB Drive Mountpoint')
-
-args = parser.parse_args ()
-
-# This is ensured by argparse
-assert args.path is not None
-
-# Only accept one mode argument
-l = [args.list, args.check, args.remap, args.defaultImage]
-f = filter (lambda x: bool (x), l)
-if len (f) == 0:
-	print "No operation mode specified"
-	parser.print_help ()
-	sys.exit (10)
-elif len (f) > 1:
-	print "Please specify a single operation mode"
-	parser.print_help ()
-	sys.exit (10)
-
-# Find out device for mountpoint
-dev = get_mounted_device (args.path)
-if dev is None:
-	print "ERROR: Cannot find device mounted on %s" % args.path
-	sys.exit (20)
-
-print "Using %s, mounted on %s" % (dev, args.path)
-
-# Go!
-s = Selector (dev, args.path)
-s.scan ()
-print "Slots in use: %d" % len (s.slots)
-print "Default slot: %d" % s.defaultSlot
-print
-
-if args.verbose:
-	print "Stat bytes:"
-	print "DEC:\t%d\t%d\t%d\t%d" % (s.stats.unk1, s.stats.unk2, s.stats.unk3, s.stats.unk4)
-	print "HEX:\t%02x\t%02x\t%02x\t%02x" % (s.stats.unk1, s.stats.unk2, s.stats.unk3, s.stats.unk4)
+def get_mount_point (device):
+	"Get the mountpoint of device, or None if not mounted"
+	device = os.path.realpath (device)
+	try:
+		with open ("/proc/mounts", "r") as ifp:
+			for line in ifp:
+				fields = line.rstrip ('\n').split ()
+				if os.path.realpath (fields[0]) == device:
+					return fields[1]
+	except EnvironmentError:
+		pass
+	return None
+
+def process (path, args):
+	"""Runs the operation selected in args on a single stick, given its
+	mountpoint (or its device or image file for --defrag). Returns the exit
+	code."""
+	if not args.stats:
+		return runOperation (path, args, None)
+
+	ioStats = iostats.IOStats ()
+	try:
+		return runOperation (path, args, ioStats)
+	finally:
+		print
+		if args.stats == "json":
+			ioStats.reportJson ()
+		else:
+			ioStats.report ()
+
+def runOperation (path, args, ioStats):
+	blockCache = args.blockCache * 1024 * 1024 if args.blockCache else None
+	if args.defrag:
+		# This works on the raw device or image, which must not be mounted
+		if os.path.isdir (path):
+			print "ERROR: --defrag needs a device or image file, not a mountpoint"
+			return 20
+		elif get_mount_point (path) is not None:
+			print "ERROR: %s is mounted on %s, please unmount it first" % (path, get_mount_point (path))
+			return 20
+		fs = Fat32Filesystem (path, None, not args.noCache, writable = True, ioStats = ioStats, blockCache = blockCache)
+		# Scan the tree in its own phase, not within this one
+		fs.files
+		with fs.ioStats.phase ("defrag"):
+			nMoved = defrag (fs, args.verbose)
+		print "Moved %d images" % nMoved
+		return 0
+
+	# Find out device for mountpoint, a mounted device will do as well.
+	# Devices and images that are not mounted are accessed directly.
+	if not os.path.exists (path):
+		print "ERROR: %s does not exist" % path
+		return 20
+	elif os.path.isdir (path):
+		mountpoint = path
+	else:
+		mountpoint = get_mount_point (path)
+	if mountpoint is None:
+		dev = path
+		print "Using %s, not mounted" % dev
+	else:
+		dev = get_mounted_device (mountpoint)
+		if dev is None:
+			print "ERROR: Cannot find device mounted on %s" % mountpoint
+			return 20
+		print "Using %s, mounted on %s" % (dev, mountpoint)
+
+	if args.importImages and mountpoint is not None:
+		print "ERROR: --import needs a device or image file that is not mounted"
+		return 20
+
+	# Go!
+	writable = args.remap or args.fix or bool (args.defaultImage) or bool (args.importImages)
+	s = Selector (dev, mountpoint, not args.noCache, ioStats, blockCache, writable)
+	# Setting the default slot and importing do not need to know where slots
+	# point to
+	s.scan (resolve = not (args.defaultImage or args.importImages))
+	print "Slots in use: %d" % len (s.slots)
+	print "Default slot: %d" % s.defaultSlot
 	print
 
-if args.list:
-	for n, slot in s.slots.iteritems ():
-		if args.verbose:
-			print "%2d. %s (c=%u)" % (n, slot.diskFileName, slot.startCluster)
+	if args.verbose:
+		print "Stat bytes:"
+		print "DEC:\t%d\t%d\t%d\t%d" % (s.stats.unk1, s.stats.unk2, s.stats.unk3, s.stats.unk4)
+		print "HEX:\t%02x\t%02x\t%02x\t%02x" % (s.stats.unk1, s.stats.unk2, s.stats.unk3, s.stats.unk4)
+		print
+
+	ret = 0
+	if args.list:
+		for n, slot in s.slots.iteritems ():
+			if args.verbose:
+				print "%2d. %s (c=%u)" % (n, encodeName (slot.diskFileName), slot.startCluster)
+			else:
+				print "%2d. %s" % (n, encodeName (slot.diskFileName))
+	elif args.check:
+		nProb = checkSlots (s, args.fix)
+		if nProb == 0:
+			print "Selector is safe and sound!"
 		else:
-			print "%2d. %s" % (n, slot.diskFileName)
-elif args.check:
-	nProb = checkSlots (args.path, s.slots)
-	if nProb == 0:
-		print "Selector is safe and sound!"
-	#~ else:
-		#~ for slot in s.slots.itervalues ():
-			#~ s.updateSlot (slot)
-elif args.remap:
-	remap (s, args.verbose)
-elif args.defaultImage:
-	n = int (args.defaultImage)
-	s.setDefaultSlot (n)
-	print "Default image set to %d" % n
-	#~ s.updateSlot (s.slots[3])
+			ret = 1
+	elif args.remap:
+		remap (s, args.verbose)
+	elif args.fragmentation:
+		reportFragmentation (s, args.verbose)
+	elif args.importImages:
+		try:
+			importImages (s, args.importImages, args.target, args.verbose)
+		except (IOError, FAT.FileNotFoundError) as ex:
+			print "ERROR: %s" % ex
+			ret = 20
+	elif args.verify:
+		if verify (s, args.verbose, not args.noCache) > 0:
+			ret = 1
+	elif args.defaultImage:
+		n = int (args.defaultImage)
+		s.setDefaultSlot (n)
+		s.commit ()
+		print "Default image set to %d" % n
+		#~ s.updateSlot (s.slots[3])
+	return ret
+
+def batchWorker (task):
+	"""Runs process () on a single stick in a worker process, returning its
+	exit code and everything it printed"""
+	path, args = task
+	out = StringIO ()
+	sys.stdout = out
+	try:
+		code = process (path, args)
+	except (Exception, SelectorException) as ex:
+		print "ERROR: %s" % ex
+		code = 30
+	finally:
+		sys.stdout = sys.__stdout__
+	return path, code, out.getvalue ()
+
+def batch (paths, args):
+	"""Runs process () on many sticks at once, each in its own process, at
+	most args.jobs at a time. Progress is reported as every stick is done,
+	followed by the full output for every stick. Returns the highest exit
+	code."""
+	jobs = args.jobs or min (len (paths), multiprocessing.cpu_count ())
+	print "Processing %d sticks, %d at a time" % (len (paths), jobs)
+	results = {}
+	pool = multiprocessing.Pool (jobs)
+	try:
+		tasks = [(path, args) for path in paths]
+		for n, (path, code, output) in enumerate (pool.imap_unordered (batchWorker, tasks), start = 1):
+			print "[%d/%d] %s: %s" % (n, len (paths), path, "OK" if code == 0 else "FAILED (%d)" % code)
+			results[path] = (code, output)
+	finally:
+		pool.close ()
+		pool.join ()
+
+	for path in paths:
+		print
+		print "=== %s ===" % path
+		sys.stdout.write (results[path][1])
+	nFailed = len (filter (lambda r: r[0] != 0, results.itervalues ()))
+	print
+	print "%d sticks OK, %d failed" % (len (paths) - nFailed, nFailed)
+	return max (r[0] for r in results.itervalues ())
+
+def main ():
+	parser = argparse.ArgumentParser (description = 'Manage disk images for Amiga Gotek drives')
+	parser.add_argument ('--list', "-l", action = 'store_true', default = False, help = "List disk images")
+	parser.add_argument ('--check', "-c", action = 'store_true', default = False, help = "Check disk images")
+	parser.add_argument ('--fix', action = 'store_true', default = False,
+											 help = "With --check, update slots whose image moved and clear those whose image is gone")
+	parser.add_argument ('--remap', "-r", action = 'store_true', default = False, help = "Remap all disk images to slots")
+	parser.add_argument ('--fragmentation', "-f", action = 'store_true', default = False,
+											 help = "Report how fragmented disk images are")
+	parser.add_argument ('--verify', action = 'store_true', default = False,
+											 help = "Check that the disk images of all slots are sane and hash them")
+	parser.add_argument ('--import', metavar = "ADF", action = 'append', default = [], dest = "importImages",
+											 help = "Write a disk image (or all those in a directory) to the drive and give it a slot, can be repeated (path must be an unmounted device or an image file)")
+	parser.add_argument ('--to', metavar = "DIR", default = "", dest = "target",
+											 help = "Directory of the drive where --import puts images (default: root)")
+	parser.add_argument ('--defrag', action = 'store_true', default = False,
+											 help = "Make all disk images contiguous (path must be an unmounted device or an image file)")
+	parser.add_argument ('--set-default', "-d", metavar = "IMAGE_NO", default = None, dest = "defaultImage",
+											 help = "Number of image to set as default")
+	parser.add_argument ('--verbose', "-v", action = 'store_true', default = False, help = "Be verbose")
+	parser.add_argument ('--no-cache', action = 'store_true', default = False, dest = "noCache",
+											 help = "Always scan the whole device, ignoring and not saving the scan cache")
+	parser.add_argument ('--block-cache', metavar = "MIB", default = None, type = int, dest = "blockCache",
+											 help = "Read the device through a block cache of this size instead of mapping it in memory")
+	parser.add_argument ('--stats', action = 'store_const', const = "human", default = None,
+											 help = "Report I/O counters and phase timings")
+	parser.add_argument ('--stats-json', action = 'store_const', const = "json", dest = "stats",
+											 help = "Same as --stats, in JSON")
+	parser.add_argument ('--jobs', "-j", metavar = "N", default = None, type = int,
+											 help = "With several paths, process at most N of them at a time (default: one per CPU)")
+	parser.add_argument ('path', default = None, type = str, nargs = '+',
+											 help = 'USB drive mountpoint, or device or image file if not mounted (--defrag needs the latter), several can be given')
+
+	args = parser.parse_args ()
+
+	# This is ensured by argparse
+	assert args.path
+
+	# Only accept one mode argument
+	l = [args.list, args.check, args.remap, args.fragmentation, args.verify, args.importImages, args.defrag, args.defaultImage]
+	f = filter (lambda x: bool (x), l)
+	if len (f) == 0:
+		print "No operation mode specified"
+		parser.print_help ()
+		sys.exit (10)
+	elif len (f) > 1:
+		print "Please specify a single operation mode"
+		parser.print_help ()
+		sys.exit (10)
+	elif args.fix and not args.check:
+		print "--fix can only be used with --check"
+		sys.exit (10)
+
+	if len (args.path) > 1:
+		sys.exit (batch (args.path, args))
+	else:
+		sys.exit (process (args.path[0], args))
 
+if __name__ == "__main__":
+	main ()